@@ -0,0 +1,24 @@
+"""What the benchmarks share: the repository root, on sys.path so iboto
+imports from the checkout, and timing helpers."""
+
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+def median(li):
+    li = sorted(li)
+    return li[len(li) // 2]
+
+def timed(fn, runs, setup=None):
+    """The median seconds fn takes over runs calls, calling setup untimed before each."""
+    times = []
+    for _ in xrange(runs):
+        if setup:
+            setup()
+        start = time.time()
+        fn()
+        times.append(time.time() - start)
+    return median(times)
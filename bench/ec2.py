@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+"""Measure iboto's EC2 operations against the in-process mock backend.
+
+Usage:
+  python bench/ec2.py [-n RUNS] [-s SIZES] [-a ACCOUNTS] [-r REGIONS] [-l LATENCY] [--rate RATE]
+
+For each fleet size (default 10, 1000 and 10000 instances, spread over
+5 accounts x 4 regions) times listing (ec2din) with and without the
+snapshot cache, until its first row and as a new session does from the
+fleet store, a chain of %limit filters, building and querying the
+completion index, an ec2watch tick and bulk tagging. Every mock request
+sleeps LATENCY seconds (default 0.05), roughly an EC2 round trip; --rate
+caps requests per second per region as EC2 does. No AWS account is needed,
+and a throwaway HOME is used so ~/.iboto is left alone.
+"""
+
+import optparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from common import timed
+
+REGIONS = ['us-east-1', 'us-west-1', 'us-west-2', 'eu-west-1', 'ap-southeast-1', 'sa-east-1', 'ap-northeast-1']
+
+class quiet(object):
+    """Send stdout to /dev/null, for timing commands that print."""
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+
+    def __exit__(self, *exc):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+def setup_iboto(size, accounts=5, regions=4, latency=0.05, rate=None):
+    """An IBoto selecting every account/region of a mock fleet of about size instances."""
+    from iboto import ipythonext as ext
+    backend = 'mock:size=%d,latency=%s' % (max(size // accounts, 1), latency)
+    if rate:
+        backend += ',rate=%s' % rate
+    ib = ext.IBoto(backend=backend)
+    ib.accounts = [ ext.Account(name='acc%d' % n, access_key=u'mock', secret_key=u'mock', regions=REGIONS[:regions])
+                    for n in xrange(accounts) ]
+    ib.filters[:] = ext.Filters([ ext.ConnectionList( ext.Connection(acc, reg) for acc in ib.accounts
+                                                      for reg in acc.regions ) ])
+    ext.iboto = ib
+    return ib
+
+def bench_size(size, opts):
+    from iboto import ipythonext as ext
+    ib = setup_iboto(size, opts.accounts, opts.regions, opts.latency, opts.rate)
+    ext.ask_yes_no = lambda *args, **kwargs: True
+    n = len(list(ib.instances.refresh()))
+    print '%d instances over %d connections' % (n, len(ib.connections()))
+
+    def result(name, t):
+        print '  %-30s %9.1fms' % (name, t * 1000)
+
+    def ls():
+        with quiet():
+            ib.instances.ls()
+    result('ec2din (first row)', timed(lambda: iter(ib.instances).next(), opts.runs, setup=ext.snapshots.invalidate))
+    result('ec2din', timed(ls, opts.runs, setup=ext.snapshots.invalidate))
+    result('ec2din (cached)', timed(ls, opts.runs))
+
+    def new_session():
+        # as a new session starts, with only the fleet store to go on
+        ext.snapshots.invalidate()
+        ext.fleet_store.reset(ext.fleet_store.path)
+    result('ec2din (new session, stored)', timed(ls, opts.runs, setup=new_session))
+
+    def limit_chain():
+        I = ib.instances
+        for f in ('Role:web', 'm1.small', 'running', '/web1/'):
+            I = I.limit(*ext.parse_filter_list(f))
+        list(I)
+    result('limit Role:web m1.small ...', timed(limit_chain, opts.runs, setup=ext.snapshots.invalidate))
+    result('limit ... (cached)', timed(limit_chain, opts.runs))
+
+    def build():
+        ext.completions._entry = None
+        ext.completions.build(ib.filters)
+    result('completion index build', timed(build, opts.runs, setup=ext.snapshots.invalidate))
+    result('complete i-1', timed(lambda: ext.completions.complete(ib.filters, 'i-1'), opts.runs))
+    result('complete Role:w', timed(lambda: ext.completions.complete(ib.filters, 'Role:w'), opts.runs))
+
+    watcher = ib.instances.watch()
+    def tick():
+        new = watcher.snapshot()
+        list(watcher.diff(watcher.current, new))
+        watcher.current = new
+    result('ec2watch tick', timed(tick, opts.runs))
+
+    def tag():
+        ib.instances.add_tag('Bench', str(time.time()))
+    result('add_tag (all)', timed(tag, opts.runs))
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-n', '--runs', type='int', default=3, help='runs per measurement, the median is shown')
+    parser.add_option('-s', '--sizes', default='10,1000,10000', help='comma separated fleet sizes')
+    parser.add_option('-a', '--accounts', type='int', default=5)
+    parser.add_option('-r', '--regions', type='int', default=4, help='regions per account (at most %d)' % len(REGIONS))
+    parser.add_option('-l', '--latency', type='float', default=0.05, help='seconds added to every request')
+    parser.add_option('--rate', type='float', help='requests per second allowed per region')
+    opts, args = parser.parse_args()
+
+    home = tempfile.mkdtemp(prefix='iboto-bench-')
+    os.environ['HOME'] = home
+    try:
+        for size in opts.sizes.split(','):
+            bench_size(int(size), opts)
+    finally:
+        shutil.rmtree(home)
+
+if __name__ == '__main__':
+    main()
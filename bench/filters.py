@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+"""Measure applying %limit filters to a synthetic fleet.
+
+Usage:
+  python bench/filters.py [-s SIZES] [-n RUNS]
+
+For each fleet size (default 1000 and 10000 instances of the mock
+backend, parsed once into InstanceRecords) times several filter lists two
+ways: stacked, a generator per filter with each union testing its members
+one by one as Filters.resolve used to, and compiled, the single predicate
+resolve builds now. Also times parsing each filter list afresh against
+reusing the remembered parse. No network or AWS account is involved.
+"""
+
+import optparse
+
+from common import timed
+
+def fleet(size):
+    from iboto import ipythonext as ext
+    from iboto import mock
+    f = mock.MockFleet(size=size, regions=['us-east-1'])
+    conn = mock.MockEC2Connection(f, 'us-east-1')
+    return ext.parse_instances(conn.make_request('DescribeInstances').read())
+
+def cases(records):
+    ids = [ i.id for i in records[::max(len(records) // 500, 1)][:500] ]
+    return [
+        ('500 ids', ' '.join(ids)),
+        ('50 id prefixes', ' '.join( i[:-1] for i in ids[:50] )),
+        ('Role:web m1.small running /web1/', 'Role:web m1.small running /web1/'),
+        ('20 Name regexes', ' '.join( '/web%d$/' % n for n in xrange(20) )),
+        ('/web/ running 500 ids', '/web/ running ' + ' '.join(ids)),
+    ]
+
+def union(members, li):
+    for i in li:
+        for f in members:
+            if f.select(i):
+                yield i
+                break
+
+def stacked(filters, li):
+    from iboto import ipythonext as ext
+    for f in filters:
+        if isinstance(f, ext.UnionFilter):
+            li = union(f.filters, li)
+        else:
+            li = f.filter(li)
+    return li
+
+def compiled(filters, li):
+    from iboto import ipythonext as ext
+    for stage in ext.Filters._compile(filters):
+        li = stage(li)
+    return li
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [-s SIZES] [-n RUNS]')
+    parser.add_option('-s', '--sizes', default='1000,10000', help='comma separated fleet sizes')
+    parser.add_option('-n', '--runs', type='int', default=3, help='runs per measurement, the median is shown')
+    opts, args = parser.parse_args()
+
+    from iboto import ipythonext as ext
+    for size in opts.sizes.split(','):
+        records = fleet(int(size))
+        print '%d instances (median of %d)' % (len(records), opts.runs)
+        print '  %-36s %10s %10s %8s' % ('', 'stacked', 'compiled', 'matched')
+        for name, arg in cases(records):
+            filters = ext.parse_filter_list(arg)
+            n = len(list(compiled(filters, records)))
+            assert n == len(list(stacked(filters, records))), name
+            before = timed(lambda: list(stacked(filters, records)), opts.runs)
+            after = timed(lambda: list(compiled(filters, records)), opts.runs)
+            print '  %-36s %8.1fms %8.1fms %8d' % (name, before * 1000, after * 1000, n)
+
+    print 'parse_filter_list (median of %d)' % opts.runs
+    print '  %-36s %10s %10s' % ('', 'parsed', 'reused')
+    for name, arg in cases(records):
+        before = timed(lambda: ext._parse_filter_list(arg), opts.runs)
+        ext.parse_filter_list(arg)
+        after = timed(lambda: ext.parse_filter_list(arg), opts.runs)
+        print '  %-36s %8.3fms %8.3fms' % (name, before * 1000, after * 1000)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+"""Compare boto's DescribeInstances parsing with iboto's InstanceRecords.
+
+Usage:
+  python bench/parse.py [-s SIZE] [-n RUNS]
+
+Renders a DescribeInstances response for SIZE instances (default 20000)
+with the mock backend, then for each parser prints the time taken to parse
+it and the memory held by the resulting instances. Each parser runs in a
+fresh interpreter so the memory figures don't mix.
+"""
+
+import optparse
+import subprocess
+import sys
+import time
+
+from common import median
+
+def response(size):
+    from iboto import mock
+    fleet = mock.MockFleet(size=size, regions=['us-east-1'])
+    conn = mock.MockEC2Connection(fleet, 'us-east-1')
+    return conn.make_request('DescribeInstances').read()
+
+def parse_boto(body):
+    import boto.handler
+    import xml.sax
+    from boto.ec2.instance import Reservation
+    from boto.resultset import ResultSet
+    rs = ResultSet([('item', Reservation)])
+    xml.sax.parseString(body, boto.handler.XmlHandler(rs, None))
+    return [ i for r in rs for i in r.instances ]
+
+def parse_records(body):
+    from iboto import ipythonext
+    return ipythonext.parse_instances(body)
+
+PARSERS = [('boto Reservation/Instance', parse_boto), ('iboto InstanceRecord', parse_records)]
+
+def rss_kb():
+    # current resident set size, from /proc where available
+    try:
+        for line in open('/proc/self/status'):
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    except IOError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def child(name, size, runs):
+    parse = dict(PARSERS)[name]
+    body = response(size)
+    times = []
+    for _ in xrange(runs):
+        start = time.time()
+        li = parse(body)
+        times.append(time.time() - start)
+        del li
+    before = rss_kb()
+    li = parse(body)
+    print median(times), rss_kb() - before, len(li)
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [-s SIZE] [-n RUNS]')
+    parser.add_option('-s', '--size', type='int', default=20000, help='instances in the response')
+    parser.add_option('-n', '--runs', type='int', default=3, help='runs per measurement, the median is shown')
+    parser.add_option('--child', help=optparse.SUPPRESS_HELP)
+    opts, args = parser.parse_args()
+    if opts.child:
+        return child(opts.child, opts.size, opts.runs)
+
+    print 'DescribeInstances, %d instances (median of %d)' % (opts.size, opts.runs)
+    for name, _ in PARSERS:
+        out = subprocess.check_output([sys.executable, __file__, '--child', name,
+                                       '-s', str(opts.size), '-n', str(opts.runs)])
+        t, kb, n = out.split()
+        print '  %-28s %8.0fms %8.1fMB held' % (name, float(t) * 1000, int(kb) / 1024.0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+"""Measure how long iboto takes to start.
+
+Usage:
+  python bench/startup.py [-n RUNS]
+
+Prints the import time of each module iboto loads, every one measured in a
+fresh interpreter, followed by the time from launching scripts/iboto to its
+first prompt. iboto runs with a throwaway HOME holding a dummy account, so
+the configuration wizard is skipped and the timings don't depend on your
+~/.iboto; the background connection warm-up is left to fail quietly.
+"""
+
+import optparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from common import ROOT, median
+
+# (module, modules already loaded when it is imported)
+IMPORTS = [
+    ('IPython.frontend.terminal.embed', []),
+    ('boto', []),
+    ('boto.ec2', ['boto']),
+    ('urllib2', []),
+    ('readline', []),
+    ('ConfigParser', []),
+    ('iboto.ipythonext', ['IPython.frontend.terminal.embed']),
+]
+
+SETTINGS = """[dummy]
+aws_access_key_id = AKIDUMMY
+aws_secret_access_key = dummy
+regions = us-east-1
+"""
+
+def import_time(module, preloaded):
+    code = ('import sys, time; sys.argv = ["iboto"]\n'
+            + ''.join('import %s\n' % m for m in preloaded)
+            + 't = time.time(); import %s; print time.time() - t' % module)
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    out = subprocess.check_output([sys.executable, '-c', code], env=env, cwd=ROOT,
+                                  stderr=open(os.devnull, 'w'))
+    return float(out.split()[-1])
+
+def time_to_prompt(home):
+    env = dict(os.environ, HOME=home, PYTHONPATH=ROOT)
+    start = time.time()
+    p = subprocess.Popen([sys.executable, os.path.join(ROOT, 'scripts', 'iboto')], env=env,
+                         stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=open(os.devnull, 'w'))
+    out = ''
+    while ']: ' not in out:
+        c = p.stdout.read(1)
+        if not c:
+            raise RuntimeError('iboto exited before prompting:\n%s' % out)
+        out += c
+    elapsed = time.time() - start
+    p.communicate('exit\n')
+    return elapsed
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [-n RUNS]')
+    parser.add_option('-n', '--runs', type='int', default=5, help='runs per measurement, the median is shown')
+    opts, args = parser.parse_args()
+
+    print 'import time (median of %d)' % opts.runs
+    for module, preloaded in IMPORTS:
+        t = median([ import_time(module, preloaded) for _ in xrange(opts.runs) ])
+        after = preloaded and ' (after %s)' % ', '.join(preloaded) or ''
+        print '  %-35s %7.1fms%s' % (module, t * 1000, after)
+
+    home = tempfile.mkdtemp(prefix='iboto-bench-')
+    try:
+        os.mkdir(os.path.join(home, '.iboto'))
+        with open(os.path.join(home, '.iboto', 'settings'), 'w') as fout:
+            fout.write(SETTINGS)
+        times = [ time_to_prompt(home) for _ in xrange(opts.runs) ]
+    finally:
+        shutil.rmtree(home)
+    print 'time to prompt (median of %d)' % opts.runs
+    print '  %-35s %7.1fms  (min %.1fms, max %.1fms)' % ('scripts/iboto', median(times) * 1000,
+                                                       min(times) * 1000, max(times) * 1000)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+"""Measure counting and selecting instances with I.table().
+
+Usage:
+  python bench/table.py [-s SIZES] [-n RUNS]
+
+For each fleet size (default 1000 and 100000 instances of the mock
+backend, parsed once into InstanceRecords) times building the table, then
+several queries two ways: a python loop over the records, as you'd write
+against I, and the table's where/count. Uses numpy when it is installed,
+the plain array fallback otherwise. No network or AWS account is involved.
+"""
+
+import collections
+import optparse
+
+from common import timed
+
+def fleet(size):
+    from iboto import ipythonext as ext
+    from iboto import mock
+    f = mock.MockFleet(size=size, regions=['us-east-1'])
+    conn = mock.MockEC2Connection(f, 'us-east-1')
+    return ext.parse_instances(conn.make_request('DescribeInstances').read(), conn)
+
+# (name, python loop over records, query on a table)
+CASES = [
+    ('count by state',
+     lambda li: collections.Counter( i.state for i in li ),
+     lambda t: t.count('state')),
+    ('count by zone, type',
+     lambda li: collections.Counter( (i.placement, i.instance_type) for i in li ),
+     lambda t: t.count('zone', 'type')),
+    ('m1.small running by Role',
+     lambda li: collections.Counter( i.tags.get('Role') for i in li
+                                     if i.instance_type == 'm1.small' and i.state == 'running' ),
+     lambda t: t.where(type='m1.small', state='running').count('Role')),
+    ('2 types in 2 zones',
+     lambda li: [ i for i in li if i.instance_type in ('m1.small', 'm1.large')
+                  and i.placement in ('us-east-1a', 'us-east-1b') ],
+     lambda t: t.where(type=['m1.small', 'm1.large'], zone=['us-east-1a', 'us-east-1b'])),
+]
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [-s SIZES] [-n RUNS]')
+    parser.add_option('-s', '--sizes', default='1000,100000', help='comma separated fleet sizes')
+    parser.add_option('-n', '--runs', type='int', default=3, help='runs per measurement, the median is shown')
+    opts, args = parser.parse_args()
+
+    from iboto import ipythonext as ext
+    print 'numpy: %s' % (ext._numpy() and 'yes' or 'no')
+    for size in opts.sizes.split(','):
+        records = fleet(int(size))
+        print '%d instances (median of %d)' % (len(records), opts.runs)
+        build = timed(lambda: ext.Table.build(records, tags=['Role']), opts.runs)
+        print '  %-36s %10s %8.1fms' % ('build table', '', build * 1000)
+        table = ext.Table.build(records, tags=['Role'])
+        print '  %-36s %10s %10s' % ('', 'loop', 'table')
+        for name, loop, query in CASES:
+            expected, got = loop(records), query(table)
+            if isinstance(got, ext.Table):
+                assert [ i.id for i in expected ] == got['id'], name
+            else:
+                assert expected == got, name
+            before = timed(lambda: loop(records), opts.runs)
+            after = timed(lambda: query(table), opts.runs)
+            print '  %-36s %8.1fms %8.1fms' % (name, before * 1000, after * 1000)
+
+if __name__ == '__main__':
+    main()
@@ -1,28 +1,41 @@
+# boto, urllib2, readline and ConfigParser are imported where first used,
+# to keep them off the shell's startup time (see bench/startup.py)
 import sys
 import os
 import re
 import datetime
 import time
 import optparse
-import boto.ec2
 import socket
+import signal
 import itertools
+import functools
+import collections
+import bisect
+import heapq
+import random
+import threading
+import Queue
 from IPython.core.error import UsageError
 from IPython.utils.io import ask_yes_no
-import ConfigParser
+from IPython.utils.warn import warn
 from IPython.config.configurable import Configurable
-from IPython.utils.traitlets import Unicode, Instance, List, Any
-import urllib2
+from IPython.utils.traitlets import Unicode, Instance, List, Any, Int, Float, Bool
+import json
 
 def load_ipython_extension(ipython):
     global ip
     ip = ipython
 
     ip.define_magic('ec2ssh', ec2ssh)
+    ip.define_magic('ec2pssh', ec2pssh)
+    ip.define_magic('ec2probe', ec2probe)
     ip.define_magic('ec2din', ec2din)
     ip.define_magic('ls', ec2din)
     ip.define_magic('ec2run', ec2run)
     ip.define_magic('ec2watch', ec2watch)
+    ip.define_magic('ec2wait', ec2wait)
+    ip.define_magic('ec2summary', ec2summary)
 
     ip.define_magic('account', magic_account)
     ip.define_magic('region', magic_region)
@@ -30,6 +43,9 @@ def load_ipython_extension(ipython):
     ip.define_magic('.', magic_limit)
     ip.define_magic('pop', magic_pop)
     ip.define_magic('..', magic_pop)
+    ip.define_magic('refresh', magic_refresh)
+    ip.define_magic('ec2stats', magic_ec2stats)
+    ip.define_magic('offline', magic_offline)
 
     _define_ec2cmd(ip, 'ec2start', 'start', 'stopped')
     _define_ec2cmd(ip, 'ec2stop', 'stop', 'running')
@@ -38,14 +54,22 @@ def load_ipython_extension(ipython):
     
     ip.set_hook('complete_command', instance_completer_factory(), re_key = '%?ec2din')
     ip.set_hook('complete_command', instance_completer_factory(), re_key = '%?ec2watch')
+    ip.set_hook('complete_command', instance_completer_factory(), re_key = '%?ec2probe')
+    ip.set_hook('complete_command', instance_completer_factory(), re_key = '%?ec2summary')
+    ip.set_hook('complete_command', wait_completer, re_key = '%?ec2wait')
     ip.set_hook('complete_command', ec2run_parameters.completer, re_key = '%?ec2run')
     ip.set_hook('complete_command', ec2run_parameters.completer, re_key = '%?ec2-run-instances')
     ip.set_hook('complete_command',
-                instance_completer_factory(filters={'instance-state-name': 'running'}),
+                instance_completer_factory(states=['running']),
                 re_key = '%?ec2ssh')
+    ip.set_hook('complete_command',
+                instance_completer_factory(states=['running']),
+                re_key = '%?ec2pssh')
     ip.set_hook('complete_command', account_completers, re_key = '%?account')
     ip.set_hook('complete_command', region_completers, re_key = '%?region')
     ip.set_hook('complete_command', instance_completer_factory(), re_key = r'%?(limit|\.)')
+    ip.set_hook('pre_prompt_hook', new_prompt)
+    ip.register_post_execute(trace_command)
     
     global iboto
     iboto = IBoto(config=ip.config)
@@ -53,6 +77,7 @@ def load_ipython_extension(ipython):
     iboto.command_line()
     ip.user_ns['iboto'] = iboto
     ip.user_ns['I'] = iboto.instances
+    completions.refresh(iboto.filters)
 
 ######################################################
 # Constants
@@ -72,6 +97,894 @@ ATTRIBUTE_FILTERS = {
     'state': STATES,
 }
 
+# instance attributes that DescribeInstances can filter on server side
+SERVER_FILTERS = {
+    'id': 'instance-id',
+    'image_id': 'image-id',
+    'instance_type': 'instance-type',
+    'architecture': 'architecture',
+    'state': 'instance-state-name',
+    'groups': 'instance.group-name', # group-name only matches EC2-Classic groups
+}
+
+######################################################
+# Concurrency
+######################################################
+
+class Cancelled(Exception):
+    """Raised instead of making an EC2 request for work that has been cancelled."""
+
+class Scope(object):
+    """Cancellation of a piece of work, and of the work it fans out to in other threads.
+
+    EC2 requests check the scope of the thread making them (see
+    Engine.bind), so once cancelled no more are made; those already sent
+    complete.
+    """
+    def __init__(self, parent=None):
+        self.parent = parent
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set() or bool(self.parent and self.parent.cancelled)
+
+_local = threading.local()
+
+def current_scope():
+    return getattr(_local, 'scope', None)
+
+def check_cancelled():
+    scope = current_scope()
+    if scope and scope.cancelled:
+        raise Cancelled('cancelled')
+
+class Pool(object):
+    """Bounded pool of threads for fanning a call out over many connections.
+
+    The calls run in a Scope of the caller's, cancelled if the caller is
+    interrupted (Ctrl+C) or stops consuming the results, so abandoned calls
+    make no further requests.
+    """
+    def __init__(self, width=8, timeout=60.0):
+        self.width = width
+        self.timeout = timeout
+
+    def _run(self, scope, results, n, fn, item):
+        _local.scope = scope
+        try:
+            results.put((n, fn(item), None))
+        except Exception, ex:
+            results.put((n, None, ex))
+
+    def map(self, fn, items, ordered=False, wait=False):
+        """Call fn(item) for every item, at most width calls at a time.
+
+        Yields (item, result) as calls complete, or in the order of items if
+        ordered is set. A call that raises or is still running after timeout
+        seconds is reported with a warning and left out of the results.
+        With wait set, for calls that change things, a call still running
+        after timeout seconds is waited for with a notice instead: giving up
+        on it wouldn't stop it, only lose its result.
+        """
+        items = list(items)
+        pending = list(enumerate(items))
+        pending.reverse()
+        running = {}
+        started = {}
+        done = {}
+        results = Queue.Queue()
+        scope = Scope(current_scope())
+        following = 0
+        try:
+            while pending or running:
+                while pending and len(running) < max(self.width, 1):
+                    n, item = pending.pop()
+                    t = threading.Thread(target=self._run, args=(scope, results, n, fn, item))
+                    t.daemon = True
+                    started[n] = time.time()
+                    running[n] = started[n] + self.timeout
+                    t.start()
+
+                try:
+                    n, result, ex = results.get(timeout=max(min(running.values()) - time.time(), 0))
+                except Queue.Empty:
+                    now = time.time()
+                    for n, deadline in running.items():
+                        if deadline > now:
+                            continue
+                        if wait:
+                            warn('%s still running after %ds, waiting for it (Ctrl+C to stop)\n' % (items[n], now - started[n]))
+                            running[n] = now + self.timeout
+                        else:
+                            warn('%s timed out after %ds, results are partial\n' % (items[n], self.timeout))
+                            del running[n]
+                            done[n] = None
+                else:
+                    if n not in running:
+                        # late result from a call we have already given up on
+                        continue
+                    del running[n]
+                    if ex:
+                        if not isinstance(ex, Cancelled):
+                            warn('%s failed (%s), results are partial\n' % (items[n], ex))
+                        done[n] = None
+                    else:
+                        done[n] = (items[n], result)
+
+                while done:
+                    if ordered:
+                        if following not in done:
+                            break
+                        n = following
+                        following += 1
+                    else:
+                        n = done.keys()[0]
+                    r = done.pop(n)
+                    if r:
+                        yield r
+        finally:
+            # interrupted, abandoned or timed out, calls still going are of no use
+            scope.cancel()
+
+    def _produce(self, scope, results, n, fn, item):
+        _local.scope = scope
+        def put(msg):
+            # give up if the consumer has gone away
+            while not scope.cancelled:
+                try:
+                    results.put(msg, timeout=0.1)
+                    return True
+                except Queue.Full:
+                    pass
+            return False
+        try:
+            for value in fn(item):
+                if not put((n, value, None, False)):
+                    return
+            put((n, None, None, True))
+        except Exception, ex:
+            put((n, None, ex, True))
+
+    def stream(self, fn, items):
+        """Call fn(item) for every item, at most width calls at a time.
+
+        fn returns an iterable, and (item, value) is yielded for each value
+        as soon as it is produced, so values from different items
+        interleave. Only a few values are buffered ahead of the consumer.
+        A call that raises, or produces nothing for timeout seconds, is
+        reported with a warning and yields nothing further.
+        """
+        items = list(items)
+        pending = list(enumerate(items))
+        pending.reverse()
+        running = {}
+        results = Queue.Queue(max(self.width, 1) * 2)
+        scope = Scope(current_scope())
+        try:
+            while pending or running:
+                while pending and len(running) < max(self.width, 1):
+                    n, item = pending.pop()
+                    t = threading.Thread(target=self._produce, args=(scope, results, n, fn, item))
+                    t.daemon = True
+                    running[n] = time.time() + self.timeout
+                    t.start()
+
+                try:
+                    n, value, ex, done = results.get(timeout=max(min(running.values()) - time.time(), 0))
+                except Queue.Empty:
+                    now = time.time()
+                    for n, deadline in running.items():
+                        if deadline <= now:
+                            warn('%s timed out after %ds, results are partial\n' % (items[n], self.timeout))
+                            del running[n]
+                    continue
+                if n not in running:
+                    # from a call we have already given up on
+                    continue
+                if done:
+                    del running[n]
+                    if ex and not isinstance(ex, Cancelled):
+                        warn('%s failed (%s), results are partial\n' % (items[n], ex))
+                    continue
+
+                yielded = time.time()
+                running[n] = yielded + self.timeout
+                yield items[n], value
+                # don't count time spent by the consumer against the calls
+                paused = time.time() - yielded
+                for n in running:
+                    running[n] += paused
+        finally:
+            scope.cancel()
+
+pool = Pool()
+
+def in_background(fn, *args):
+    """Run fn(*args) in a daemon thread, ignoring any error."""
+    def _run():
+        try:
+            fn(*args)
+        except Exception:
+            pass
+    t = threading.Thread(target=_run)
+    t.daemon = True
+    t.start()
+
+class Future(object):
+    """The outcome of work submitted to the engine, which runs in the background.
+
+    Waiting on result() can be interrupted with Ctrl+C, which cancels the
+    work too.
+    """
+    def __init__(self, scope, description):
+        self.scope = scope
+        self.description = description
+        self._done = threading.Event()
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def _finish(self, result, exception):
+        with self._lock:
+            self._result, self._exception = result, exception
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            fn(self)
+
+    def add_done_callback(self, fn):
+        """Call fn(future) when done, in the thread that finishes it, or now if already done."""
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def cancel(self):
+        """Stop the work making any more EC2 requests; it finishes as soon as it notices."""
+        self.scope.cancel()
+
+    def cancelled(self):
+        return self.scope.cancelled
+
+    def done(self):
+        return self._done.is_set()
+
+    def _wait(self, timeout):
+        # a timed wait, in slices so Ctrl+C gets through
+        deadline = timeout is not None and time.time() + timeout
+        try:
+            while not self._done.wait(0.1):
+                if deadline and time.time() > deadline:
+                    raise RuntimeError('%s still running after %ss' % (self.description, timeout))
+        except KeyboardInterrupt:
+            self.cancel()
+            raise
+
+    def result(self, timeout=None):
+        """Wait for the work to finish, returning its result or raising what it raised."""
+        self._wait(timeout)
+        if self._exception:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        """Wait for the work to finish, returning what it raised or None."""
+        self._wait(timeout)
+        return self._exception
+
+    def __repr__(self):
+        if not self.done():
+            state = self.cancelled() and 'cancelling' or 'running'
+        elif self._exception:
+            state = 'failed (%s)' % self._exception
+        else:
+            state = 'done, see result()'
+        return '<Future: %s, %s>' % (self.description, state)
+
+THROTTLE_ERRORS = ('RequestLimitExceeded', 'Throttling')
+RETRIES = 6             # retries of a request EC2 throttled or failed (5xx)
+BACKOFF = (0.1, 20.0)   # seconds before the first retry, and the most, doubling in between
+MIN_RATE = 1.0          # requests per second a throttled account/region is slowed to at most
+NOT_RETRIED = ('RunInstances',) # may have taken effect despite a 5xx
+
+class TokenBucket(object):
+    """Request rate limit for one account/region, of rate requests per second.
+
+    Each time EC2 throttles, the rate is halved (down to MIN_RATE); each
+    request then allowed adds a little back, regaining the full rate over
+    a few seconds once the throttling stops. A rate of 0 is no limit.
+    """
+    def __init__(self, rate):
+        self.max_rate = self.rate = rate
+        self.tokens = rate # a second's worth of requests may burst
+        self.last = time.time()
+        self._lock = threading.Lock()
+
+    def take(self):
+        """Take a token, sleeping until it is due. Returns the seconds slept."""
+        if not self.max_rate:
+            return 0.0
+        with self._lock:
+            now = time.time()
+            self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            # taken in advance, so waiters queue up rather than race
+            self.tokens -= 1
+            wait = max(-self.tokens / self.rate, 0.0)
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def throttled(self):
+        if self.max_rate:
+            with self._lock:
+                self.rate = max(self.rate / 2, min(MIN_RATE, self.max_rate))
+                self.tokens = min(self.tokens, 0)
+
+    def allowed(self):
+        if self.max_rate:
+            with self._lock:
+                self.rate = min(self.rate + 1 / self.rate, self.max_rate)
+
+def is_throttled(status, body):
+    return status in (400, 503) and [ c for c in THROTTLE_ERRORS if '<Code>%s</Code>' % c in body ]
+
+def _fail_fast(response, attempt, next_sleep):
+    # a boto retry_handler: boto would otherwise sleep and retry a 5xx
+    # itself, raising only once it gave up, so the engine never saw it
+    import boto.exception
+    if response.status >= 500:
+        raise boto.exception.BotoServerError(response.status, response.reason, response.read())
+
+class Engine(object):
+    """Where every EC2 request goes, and background work to make them is run.
+
+    Requests to each account/region are limited to per_region at a time and
+    rate a second (see TokenBucket), however many commands or futures are
+    making them, and are refused once the work making them has been
+    cancelled. A request EC2 throttles or fails with a 5xx is retried after
+    a random backoff of up to twice as long as the last.
+    """
+    def __init__(self, per_region=4, rate=20.0):
+        self.per_region = per_region
+        self.rate = rate
+        self.futures = []
+        self._limits = {}
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _limit(self, key):
+        with self._lock:
+            if key not in self._limits:
+                self._limits[key] = threading.Semaphore(max(self.per_region, 1))
+            return self._limits[key]
+
+    def _bucket(self, key):
+        with self._lock:
+            if key not in self._buckets:
+                self._buckets[key] = TokenBucket(self.rate)
+            return self._buckets[key]
+
+    def set_per_region(self, n):
+        with self._lock:
+            self.per_region = n
+            # requests in flight release the old semaphores
+            self._limits = {}
+
+    def set_rate(self, rate):
+        with self._lock:
+            self.rate = rate
+            self._buckets = {}
+
+    def _send(self, key, make_request, args):
+        limit = self._limit(key)
+        check_cancelled()
+        # polled rather than blocking, so waiting can be interrupted
+        while not limit.acquire(False):
+            time.sleep(0.01)
+            check_cancelled()
+        try:
+            return make_request(*args)
+        finally:
+            limit.release()
+
+    def bind(self, ec2, key):
+        """Send the requests of ec2, the EC2Connection for key (account name, region), through the engine.
+
+        ec2 must be instrumented (see RequestStats.instrument), so a
+        response's body can be read here and again by boto. boto's own
+        retrying of 5xx responses is turned off (see _fail_fast), so they
+        are retried here instead; it still retries failed connections.
+        """
+        import boto.exception
+        mexe = ec2._mexe
+        def _mexe(request, sender=None, override_num_retries=None, retry_handler=None):
+            return mexe(request, sender, override_num_retries, retry_handler or _fail_fast)
+        ec2._mexe = _mexe
+        make_request = ec2.make_request
+        def _make_request(action, params=None, path='/', verb='GET'):
+            bucket = self._bucket(key)
+            for attempt in itertools.count():
+                check_cancelled()
+                waited = bucket.take()
+                try:
+                    response = self._send(key, make_request, (action, params, path, verb))
+                    status, body, error = response.status, response.read(), None
+                except boto.exception.BotoServerError, ex:
+                    status, body, error = ex.status, ex.body or '', ex
+                throttled = is_throttled(status, body)
+                retry = throttled or (status >= 500 and action not in NOT_RETRIED)
+                if not retry or attempt == RETRIES:
+                    if not throttled:
+                        bucket.allowed()
+                    request_stats.waited(key, action, waited, 0)
+                    if error:
+                        raise error
+                    return response
+                if throttled:
+                    bucket.throttled()
+                backoff = random.uniform(0, min(BACKOFF[0] * 2 ** attempt, BACKOFF[1]))
+                request_stats.waited(key, action, waited + backoff, 1)
+                time.sleep(backoff)
+        ec2.make_request = _make_request
+        return ec2
+
+    def submit(self, description, fn, *args, **kwargs):
+        """Run fn(*args, **kwargs) in the background, returning a Future of its result."""
+        future = Future(Scope(), description)
+        def _run():
+            _local.scope = future.scope
+            try:
+                result = fn(*args, **kwargs)
+            except Exception, ex:
+                future._finish(None, ex)
+            else:
+                future._finish(result, None)
+        with self._lock:
+            self.futures = [ f for f in self.futures if not f.done() ] + [future]
+        t = threading.Thread(target=_run)
+        t.daemon = True
+        t.start()
+        return future
+
+    def cancel_all(self):
+        """Cancel every future still running, returning how many there were."""
+        with self._lock:
+            running = [ f for f in self.futures if not f.done() ]
+        for f in running:
+            f.cancel()
+        return len(running)
+
+engine = Engine()
+
+######################################################
+# Caching
+######################################################
+
+class SnapshotCache(object):
+    """The last listing of instances for each account/region, kept for ttl seconds.
+
+    A listing loaded from the fleet store is put as stale: it is answered
+    from whatever its age until a fresh listing replaces it. A listing
+    begun before its account/region was invalidated (see version) is
+    dropped, as it may predate the change that invalidated it. Listings
+    made with filters are dropped once expired, or when a full listing of
+    their account/region is put.
+    """
+    def __init__(self, ttl=30.0):
+        self.ttl = ttl
+        self.generation = 0 # bumped whenever snapshots are invalidated or revalidated
+        self._snapshots = {}
+        self._versions = {}
+        self._cleared = 0
+        self._revalidated = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _filters_key(filters):
+        return tuple(sorted( (k, tuple(v)) for k, v in (filters or {}).iteritems() ))
+
+    def _usable(self, snapshot, any_age, checked):
+        if not snapshot or checked and snapshot[2]:
+            return False
+        return any_age or snapshot[2] or time.time() - snapshot[0] < self.ttl
+
+    def get(self, key, filters=None, any_age=False, checked=False):
+        """The listing for key, or None if there's none recent enough.
+
+        A listing made without filters answers for any, applied locally.
+        Set checked to not be answered from a stale listing.
+        """
+        with self._lock:
+            listed = self._snapshots.get(key, {})
+            snapshot, whole = listed.get(self._filters_key(filters)), listed.get(())
+        if self._usable(snapshot, any_age, checked):
+            return snapshot[1]
+        if filters and self._usable(whole, any_age, checked):
+            return [ i for i in whole[1] if server_match(i, filters) ]
+        return None
+
+    def version(self, key):
+        """Where key's invalidations are up to, to hand put for a listing begun now."""
+        with self._lock:
+            return (self._cleared, self._versions.get(key, 0))
+
+    def put(self, key, instances, filters=None, when=None, stale=False, version=None):
+        """Keep a listing for key, unless key was invalidated since version. Returns whether kept."""
+        with self._lock:
+            if version is not None and version != (self._cleared, self._versions.get(key, 0)):
+                return False
+            listed = self._snapshots.setdefault(key, {})
+            if not filters and not stale and listed.get((), (0, None, False))[2]:
+                # revalidated, so lists made from the stale one are redone
+                self.generation += 1
+            if not filters:
+                # the full listing answers for any filters, and is newer
+                listed.clear()
+            else:
+                for k, snapshot in listed.items():
+                    if k and not self._usable(snapshot, False, False):
+                        del listed[k]
+            listed[self._filters_key(filters)] = (when or time.time(), instances, stale)
+            return True
+
+    def stale_age(self, key):
+        """Seconds since the listing for key was made if it is stale, else None."""
+        with self._lock:
+            snapshot = self._snapshots.get(key, {}).get(())
+        if snapshot and snapshot[2]:
+            return time.time() - snapshot[0]
+        return None
+
+    def start_revalidation(self, key):
+        """Whether to relist key, which has a stale listing: not if already begun within ttl seconds."""
+        with self._lock:
+            if time.time() - self._revalidated.get(key, 0) < self.ttl:
+                return False
+            self._revalidated[key] = time.time()
+            return True
+
+    def invalidate(self, keys=None):
+        """Forget the snapshots for the given account/regions, or all of them."""
+        with self._lock:
+            self.generation += 1
+            if keys is None:
+                self._cleared += 1
+                self._snapshots.clear()
+            for key in keys or []:
+                self._versions[key] = self._versions.get(key, 0) + 1
+                self._snapshots.pop(key, None)
+
+    def invalidate_instances(self, instances):
+        self.invalidate(set(instance_key(i) for i in instances))
+
+# instance attributes by DescribeInstances filter name
+SERVER_ATTRIBUTES = dict( (v, k) for k, v in SERVER_FILTERS.iteritems() )
+
+def server_match(i, filters):
+    """Whether DescribeInstances with filters would list i, to apply them to a full listing."""
+    for name, values in filters.iteritems():
+        if name.startswith('tag:'):
+            have = [i.tags.get(name[4:])]
+        elif name == 'instance.group-name':
+            have = [ g.name for g in i.groups ]
+        else:
+            have = [getattr(i, SERVER_ATTRIBUTES[name])]
+        if not set(have) & set(values):
+            return False
+    return True
+
+def instance_key(i):
+    return (getattr(i, 'account', None), i.connection.region.name)
+
+snapshots = SnapshotCache()
+
+STORE_HISTORY = 30 * 24 * 60 * 60 # seconds the fleet store keeps instances no longer listed
+STORE_INTERVAL = 60 # seconds between saves of an account/region whose instances and states are unchanged
+STORE_RETRIES = 3 # attempts at a read or write of the fleet store
+
+STORE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS listings (account TEXT, region TEXT, time REAL, PRIMARY KEY (account, region));
+CREATE TABLE IF NOT EXISTS instances (account TEXT, region TEXT, id TEXT, state TEXT, instance_type TEXT,
+                                      launch_time TEXT, name TEXT, data TEXT, first_seen REAL, last_seen REAL,
+                                      PRIMARY KEY (account, region, id));
+"""
+
+class FleetStore(object):
+    """The last full listing of each account/region, kept on disk between sessions.
+
+    A sqlite database: listings holds when each account/region was last
+    listed, instances a row per instance with the record as JSON in data,
+    and when the instance was first and last listed. Rows not in the last
+    listing are instances since gone, kept STORE_HISTORY seconds, so the
+    history can be queried with sqlite3.
+
+    A session seeds the snapshot cache from it, once per account/region, so
+    commands answer at once from the last known state while a background
+    listing revalidates it. Offline, it is answered from however often.
+
+    Listings are saved at most every STORE_INTERVAL seconds per
+    account/region unless an instance came, went or changed state, so
+    frequent relisting (%ec2watch, cache expiry) doesn't rewrite the fleet
+    each time. The disk is read and written under a lock per account/region.
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.enabled = True
+        self.offline = False
+        self._seeded = set()
+        self._saved = {}
+        self._key_locks = {}
+        self._created = set()
+        self._lock = threading.Lock()
+
+    def reset(self, path):
+        """Switch database, as for a different backend."""
+        with self._lock:
+            self.path = path
+            self._seeded.clear()
+            self._saved.clear()
+
+    def _key_lock(self, key):
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def _connect(self):
+        import sqlite3
+        with self._lock:
+            path = self.path
+            if path not in self._created:
+                # once per path: creating the tables while another connection
+                # runs a statement fails it with "database schema has changed"
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                db = sqlite3.connect(path, timeout=10)
+                try:
+                    db.executescript(STORE_SCHEMA)
+                finally:
+                    db.close()
+                self._created.add(path)
+        return sqlite3.connect(path, timeout=10)
+
+    def _retrying(self, fn, *args):
+        # another session may be creating or writing the store
+        import sqlite3
+        for attempt in xrange(STORE_RETRIES):
+            try:
+                return fn(*args)
+            except sqlite3.OperationalError:
+                if attempt == STORE_RETRIES - 1:
+                    raise
+                time.sleep(0.1 * (attempt + 1))
+
+    def load(self, key, connection=None):
+        """(time listed, InstanceRecords) of the last listing of key, or None."""
+        db = self._connect()
+        try:
+            row = db.execute('SELECT time FROM listings WHERE account = ? AND region = ?', key).fetchone()
+            if not row:
+                return None
+            shared = {}
+            rows = db.execute('SELECT data FROM instances WHERE account = ? AND region = ? AND last_seen = ?',
+                              key + row)
+            return row[0], [ InstanceRecord.from_dict(json.loads(data), connection, shared) for data, in rows ]
+        finally:
+            db.close()
+
+    def seed(self, conn):
+        """Put the stored listing of conn in the snapshot cache as stale, if not done already."""
+        if not self.enabled or not self.path:
+            return
+        import sqlite3
+        with self._lock:
+            first = conn.key not in self._seeded
+            self._seeded.add(conn.key)
+        with self._key_lock(conn.key):
+            # others seeding conn wait here for the first to finish
+            if not first and not self.offline:
+                return
+            try:
+                stored = self._retrying(self.load, conn.key, conn.ec2)
+            except (sqlite3.Error, ValueError), ex:
+                warn('Fleet store %s unreadable (%s)\n' % (self.path, ex))
+                return
+        if stored:
+            when, li = stored
+            for i in li:
+                i.account = conn.account.name # hack - for display
+            snapshots.put(conn.key, li, when=when, stale=True)
+
+    def save(self, key, instances, when):
+        """Store instances as the listing of key made at when."""
+        if not self.enabled or not self.path:
+            return
+        import sqlite3
+        states = frozenset( (i.id, i.state) for i in instances )
+        with self._lock:
+            # iboto listed it itself, which the store mustn't override
+            self._seeded.add(key)
+            last = self._saved.get(key)
+            if last and (when < last[0] or last[1] == states and when - last[0] < STORE_INTERVAL):
+                return
+            self._saved[key] = (when, states)
+        rows = [ (i.state, i.instance_type, i.launch_time, i.tags.get('Name'), json.dumps(i.as_dict()), when)
+                 + key + (i.id,) for i in instances ]
+        with self._key_lock(key):
+            try:
+                self._retrying(self._write, key, instances, rows, when)
+            except sqlite3.Error, ex:
+                warn('Fleet store %s not updated (%s)\n' % (self.path, ex))
+
+    def _write(self, key, instances, rows, when):
+        db = self._connect()
+        try:
+            with db:
+                row = db.execute('SELECT time FROM listings WHERE account = ? AND region = ?', key).fetchone()
+                if row and row[0] >= when:
+                    return # a later listing was saved first
+                db.executemany('INSERT OR IGNORE INTO instances (account, region, id, first_seen) VALUES (?, ?, ?, ?)',
+                               [ key + (i.id, when) for i in instances ])
+                db.executemany('UPDATE instances SET state = ?, instance_type = ?, launch_time = ?, name = ?, '
+                               'data = ?, last_seen = ? WHERE account = ? AND region = ? AND id = ?', rows)
+                db.execute('INSERT OR REPLACE INTO listings VALUES (?, ?, ?)', key + (when,))
+                db.execute('DELETE FROM instances WHERE last_seen < ?', (when - STORE_HISTORY,))
+        finally:
+            db.close()
+
+fleet_store = FleetStore()
+
+# Instances are listed at most once per prompt
+prompt_count = 0
+
+def new_prompt(ip):
+    global prompt_count
+    prompt_count += 1
+    request_stats.mark()
+
+######################################################
+# Instrumentation
+######################################################
+
+# upper bounds (seconds) of the request latency histogram buckets, None for the rest
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, None)
+
+class ActionStats(object):
+    """Totals for the requests of one action (or all) on an account/region."""
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.bytes = 0
+        self.time = 0.0
+        self.slowest = 0.0
+        self.histogram = [0] * len(LATENCY_BUCKETS)
+        self.retries = 0
+        self.waited = 0.0 # seconds held back by the rate limit or backing off
+
+    def add(self, elapsed, size, error):
+        self.calls += 1
+        if error:
+            self.errors += 1
+        self.bytes += size
+        self.time += elapsed
+        self.slowest = max(self.slowest, elapsed)
+        for n, bound in enumerate(LATENCY_BUCKETS):
+            if bound is None or elapsed <= bound:
+                self.histogram[n] += 1
+                break
+
+    def wait(self, seconds, retries):
+        self.waited += seconds
+        self.retries += retries
+
+    def percentile(self, p):
+        """Upper bound of the histogram bucket the p'th percentile latency falls in."""
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.histogram):
+            seen += count
+            if seen >= p * self.calls:
+                return bound
+
+class RequestStats(object):
+    """Every EC2 request made, totalled per (account, region, action).
+
+    recent totals the requests per account/region since mark(), which is
+    called at each prompt, for the per-command trace.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.actions = {}
+            self.recent = {}
+
+    def mark(self):
+        with self._lock:
+            self.recent = {}
+
+    def record(self, key, action, elapsed, size, error):
+        with self._lock:
+            self.actions.setdefault(key + (action,), ActionStats()).add(elapsed, size, error)
+            self.recent.setdefault(key, ActionStats()).add(elapsed, size, error)
+
+    def waited(self, key, action, seconds, retries):
+        """Record time lost to throttling before a request, and whether it is being retried."""
+        if seconds or retries:
+            with self._lock:
+                self.actions.setdefault(key + (action,), ActionStats()).wait(seconds, retries)
+                self.recent.setdefault(key, ActionStats()).wait(seconds, retries)
+
+    def instrument(self, ec2, key):
+        """Record the requests made by ec2, the EC2Connection for key (account name, region)."""
+        make_request = ec2.make_request
+        def _make_request(action, params=None, path='/', verb='GET'):
+            start = time.time()
+            size, error = 0, True
+            try:
+                response = make_request(action, params, path, verb)
+                # read the body here so its transfer is timed; boto reads it once
+                body = response.read()
+                response.read = lambda *args: body
+                size, error = len(body), response.status >= 400
+                return response
+            finally:
+                self.record(key, action, time.time() - start, size, error)
+        ec2.make_request = _make_request
+        return ec2
+
+    def trace(self):
+        """Sum up the requests since mark() in a line, or None if there were none."""
+        with self._lock:
+            recent = self.recent.items()
+        if not recent:
+            return None
+        (account, region), slowest = max(recent, key=lambda (k, st): st.time)
+        s = '%d calls, %.2fs' % (sum( st.calls for _, st in recent ), sum( st.time for _, st in recent ))
+        errors = sum( st.errors for _, st in recent )
+        if errors:
+            s += ', %d errors' % errors
+        retries, waited = sum( st.retries for _, st in recent ), sum( st.waited for _, st in recent )
+        if retries or waited >= 0.01:
+            s += ', %d retries, %.2fs lost to throttling' % (retries, waited)
+        return s + ', slowest %s:%s (%.2fs)' % (account, region, slowest.time)
+
+    def report(self):
+        with self._lock:
+            actions = sorted(self.actions.items(), key=lambda (k, st): -st.time)
+        format = '%-10s %-14s %-26s %6s %5s %8s %8s %8s %8s %8s %6s %8s'
+        header = format % ('account', 'region', 'action', 'calls', 'err', 'kB', 'total s', 'mean ms', 'p90 ms', 'max ms',
+                           'retry', 'wait s')
+        lines = [header, '=' * len(header)]
+        for (account, region, action), st in actions:
+            p90 = st.percentile(0.9)
+            lines.append(format % (account[:10], region, action, st.calls, st.errors, st.bytes // 1024,
+                                   '%.2f' % st.time, '%.0f' % (st.time / st.calls * 1000),
+                                   p90 and '<%.0f' % (p90 * 1000) or '>%.0f' % (LATENCY_BUCKETS[-2] * 1000),
+                                   '%.0f' % (st.slowest * 1000), st.retries, '%.2f' % st.waited))
+        retries, waited = sum( st.retries for _, st in actions ), sum( st.waited for _, st in actions )
+        if retries or waited:
+            lines.append('%d requests retried, %.2fs lost to throttling in all' % (retries, waited))
+        return '\n'.join(lines)
+
+request_stats = RequestStats()
+
+def trace_command():
+    """Print a trace of the requests the command just run made, if tracing."""
+    global iboto
+    if not iboto.trace:
+        return
+    line = request_stats.trace()
+    if line:
+        command = (ip.history_manager.input_hist_raw[-1].split() or [''])[0].lstrip('%')
+        print '%s: %s' % (command, line)
+
 ######################################################
 # Models
 ######################################################
@@ -97,31 +1010,111 @@ class Connection(object):
         self.region = reg
         self._ec2 = None
         
-    def instances(self):
-        for r in self.ec2.get_all_instances():
-            for i in r.instances:
+    def pages(self, filters=None, fresh=False, checked=False):
+        """Yield the instances a page at a time, as they arrive from EC2.
+
+        Offline, only the listings in memory or the fleet store are used.
+        Set checked to list from EC2 rather than answer from a stale listing
+        (from the fleet store), which misses instances launched since; for
+        acting on the instances rather than showing them.
+        """
+        offline = fleet_store.offline
+        li = None
+        if not fresh or offline:
+            li = snapshots.get(self.key, filters, offline, checked)
+            if li is None and not checked:
+                fleet_store.seed(self)
+                li = snapshots.get(self.key, filters, offline)
+        if li is not None:
+            if not offline and snapshots.stale_age(self.key) is not None and snapshots.start_revalidation(self.key):
+                in_background(lambda: list(self.pages(fresh=True)))
+            yield li
+            return
+        if offline:
+            warn('%s has never been listed, so is empty offline\n' % self)
+            return
+        li = []
+        version = snapshots.version(self.key)
+        for page in describe_instance_pages(self.ec2, filters):
+            for i in page:
                 i.account = self.account.name # hack - for display
-                yield i
+            li.extend(page)
+            yield page
+        if snapshots.put(self.key, li, filters, version=version) and not filters:
+            in_background(fleet_store.save, self.key, li, time.time())
+
+    def instances(self, filters=None, fresh=False, checked=False):
+        return itertools.chain.from_iterable(self.pages(filters, fresh, checked))
+
+    @property
+    def key(self):
+        return (self.account.name, self.region)
         
     @property    
     def ec2(self):
         if not self._ec2:
-            self._ec2 = boto.ec2.connect_to_region(self.region,
-                                              aws_access_key_id = self.account.access_key,
-                                              aws_secret_access_key = self.account.secret_key,
-                                              )
+            self._ec2 = ec2_registry.get(self.account, self.region)
         return self._ec2
         
     def __str__(self):
         return '%s:%s' % (self.account.name, self.region)
         
+class ConnectionRegistry(object):
+    """EC2Connections per account/region, reused by every Connection.
+
+    Connection objects are rebuilt whenever %account or %region changes the
+    selection; sharing the EC2Connection keeps boto's pool of open HTTPS
+    (keep-alive) connections, so switching back and forth does not reconnect.
+    """
+    def __init__(self, backend='aws'):
+        self.backend = backend
+        self._ec2 = {}
+        self._warmed = set()
+        self._lock = threading.Lock()
+
+    def get(self, account, region):
+        key = (account.name, region)
+        with self._lock:
+            ec2 = self._ec2.get(key)
+        if not ec2:
+            ec2 = engine.bind(request_stats.instrument(self._connect(account, region), key), key)
+            with self._lock:
+                ec2 = self._ec2.setdefault(key, ec2)
+        return ec2
+
+    def _connect(self, account, region):
+        if self.backend.startswith('mock'):
+            from iboto import mock
+            return mock.connect(self.backend, account, region)
+        import boto.ec2
+        return boto.ec2.connect_to_region(region,
+                                          aws_access_key_id = account.access_key,
+                                          aws_secret_access_key = account.secret_key,
+                                          )
+
+    def reset(self, backend):
+        """Switch backend, dropping the connections made so far."""
+        with self._lock:
+            self.backend = backend
+            self._ec2.clear()
+            self._warmed.clear()
+
+    def warm(self, conn):
+        """Open an HTTPS connection for conn with a cheap call, unless already done."""
+        if conn.key not in self._warmed:
+            conn.ec2.get_all_zones()
+            self._warmed.add(conn.key)
+
+ec2_registry = ConnectionRegistry()
+
 class ConnectionList(list):
     def __str__(self):
         return ','.join( str(c) for c in self )
 
-    def instances(self):
-        for c in self:
-            for i in c.instances():
+    def instances(self, filters=None, fresh=False, checked=False):
+        # pages from all the connections, in the order they arrive
+        for c, page in pool.stream(lambda c: c.pages(filters, fresh, checked), self):
+            for i in page:
                 yield i
         
     @property
@@ -133,6 +1126,7 @@ class Wizard(object):
         self.filename = filename
         
     def run(self):
+        import ConfigParser
         print "Looks like this is the first time you are running iboto, let's configure an account:"
         more = True
         config = ConfigParser.RawConfigParser()
@@ -159,20 +1153,66 @@ class Wizard(object):
 
 class IBoto(Configurable):
     accounts = List(Any, config=True)
+    concurrency = Int(8, config=True)   # connections queried at once
+    region_concurrency = Int(4, config=True) # EC2 requests in flight at once per account/region
+    request_rate = Float(20.0, config=True) # EC2 requests a second per account/region, halved while throttled (0 for no limit)
+    timeout = Float(60.0, config=True)  # seconds before giving up on a connection
+    cache_ttl = Float(30.0, config=True) # seconds a listing is reused for
+    backend = Unicode(u'aws', config=True) # or 'mock:size=N,latency=S,rate=R', see iboto.mock
+    trace = Bool(False, config=True)     # print a line of EC2 request stats after each command
+    store = Bool(True, config=True)      # keep listings between sessions in ~/.iboto, see FleetStore
+    offline = Bool(False, config=True)   # answer from kept listings only, never listing from EC2
     
     def __init__(self, **kwargs):
         super(IBoto, self).__init__(**kwargs)
         self.filters = Filters()
         self.instances = Instances(self.filters)
+        pool.width = self.concurrency
+        pool.timeout = self.timeout
+        engine.set_per_region(self.region_concurrency)
+        engine.set_rate(self.request_rate)
+        snapshots.ttl = self.cache_ttl
+        ec2_registry.reset(self.backend)
+        fleet_store.reset(store_path(self.backend))
+        fleet_store.enabled = self.store
+        fleet_store.offline = self.offline
+
+    def _concurrency_changed(self, name, old, new):
+        pool.width = new
+
+    def _region_concurrency_changed(self, name, old, new):
+        engine.set_per_region(new)
+
+    def _request_rate_changed(self, name, old, new):
+        engine.set_rate(new)
+
+    def _timeout_changed(self, name, old, new):
+        pool.timeout = new
+
+    def _cache_ttl_changed(self, name, old, new):
+        snapshots.ttl = new
+
+    def _backend_changed(self, name, old, new):
+        ec2_registry.reset(new)
+        fleet_store.reset(store_path(new))
+        snapshots.invalidate()
+
+    def _store_changed(self, name, old, new):
+        fleet_store.enabled = new
+
+    def _offline_changed(self, name, old, new):
+        fleet_store.offline = new
         
     def select_all(self):
         self.filters[:] = Filters([ ConnectionList( Connection(acc, reg) for acc in self.accounts for reg in acc.regions ) ])
+        self.selection_changed()
         print self.filters
         
     def select_account(self, name):
         for acc in self.accounts:
             if acc.name == name:
                 self.filters[:] = Filters([ ConnectionList( Connection(acc, reg) for reg in acc.regions ) ])
+                self.selection_changed()
                 return True
         return False
             
@@ -180,6 +1220,15 @@ class IBoto(Configurable):
         filter = []
         accounts = set(conn.account for conn in self.filters[0] )
         self.add_filter(ConnectionList( Connection(acc, reg) for acc in accounts for reg in names ))
+        self.selection_changed()
+
+    def selection_changed(self):
+        """Connect to the new account/regions in the background, fetching launch metadata."""
+        connections = list(self.connections())
+        # fetching metadata connects too, so only connect to those it won't fetch for
+        launch_metadata.warm(connections)
+        fresh = [ c for c in connections if not launch_metadata.stale(c) ]
+        in_background(lambda: list(pool.map(ec2_registry.warm, fresh)))
         
     def add_filter(self, f):
         self.filters.add_filter(f)
@@ -189,8 +1238,64 @@ class IBoto(Configurable):
         
     def connections(self):
         return self.filters[0]
+
+    def refresh(self):
+        """Discard cached listings for the current account/regions."""
+        snapshots.invalidate(c.key for c in self.connections())
+
+    def watch(self, *filters, **kwargs):
+        """Yield a WatchEvent for each change to the selected instances.
+
+        filters are filter strings as for %limit (e.g. 'Role:web') or Filter
+        objects, narrowing the current selection. If callback is given it is
+        called with each event instead, until interrupted with Ctrl+C.
+        """
+        callback = kwargs.pop('callback', None)
+        watcher = self._limit(filters).watch(**kwargs)
+        if not callback:
+            return watcher
+        try:
+            for event in watcher:
+                callback(event)
+        except KeyboardInterrupt:
+            pass
         
+    def alist(self, *filters):
+        """List the selected instances in the background, returning a Future of them as a Result.
+
+        filters narrow the selection as for watch. Futures let several
+        listings or actions run at once, e.g.:
+
+          web, db = iboto.alist('Role:web'), iboto.alist('Role:db')
+          web.result().aterminate(), db.result().astop()
+        """
+        return self._limit(filters).alist()
+
+    def cancel(self):
+        """Cancel every Future still running."""
+        print 'Cancelled %d' % engine.cancel_all()
+
+    def _limit(self, filters):
+        # the selection narrowed by filter strings or Filter objects
+        args = []
+        for f in filters:
+            if isinstance(f, basestring):
+                args.extend(parse_filter_list(f))
+            else:
+                args.append(f)
+        return self.instances.limit(*args)
+
     def __str__(self):
+        # shown in the prompt, with the age of listings from an earlier session
+        ages = [ snapshots.stale_age(c.key) for c in self.filters and self.connections() or [] ]
+        ages = [ age for age in ages if age is not None ]
+        notes = []
+        if self.offline:
+            notes.append('offline')
+        if ages:
+            notes.append('%s old' % format_age(max(ages)))
+        if notes:
+            return '%s [%s]' % (self.filters, ', '.join(notes))
         return str(self.filters)
 
     def configure(self):
@@ -198,6 +1303,7 @@ class IBoto(Configurable):
         if not os.path.exists(iboto_cfg):
             Wizard(iboto_cfg).run()
 
+        import ConfigParser
         cfg = ConfigParser.RawConfigParser()
         cfg.read(iboto_cfg)
         accs = []
@@ -233,15 +1339,63 @@ class Filters(list):
         if len(self) > 1:
             self.pop()
     
-    def resolve(self, post_filter=None):
-        filters = self + (post_filter or [])
-        res = None
-        for f in filters:
-            if not res:
-                res = self[0].instances()
-            else:
-                res = f.filter(res)
+    def resolve(self, post_filter=None, fresh=False, checked=False):
+        """List the instances selected by the filters.
+
+        Set fresh to query AWS rather than reuse a cached listing, checked
+        to not reuse a stale one (see Connection.pages).
+        """
+        filters = self[1:] + (post_filter or [])
+        if isinstance(self[0], ConnectionList):
+            if checked and fleet_store.offline:
+                raise UsageError, 'offline, instances are only known as last listed; %offline to go back online'
+            server, filters = self._split_server_filters(filters)
+            res = self[0].instances(server, fresh, checked)
+        else:
+            res = self[0].instances()
+        for stage in self._compile(filters):
+            res = stage(res)
         return res
+
+    @staticmethod
+    def _compile(filters):
+        """Turn filters into stages, each a function of an iterable of instances.
+
+        A run of filters that test each instance alone becomes one stage with
+        a single predicate, trying the cheapest and most selective test first,
+        rather than a generator per filter. Orderings stay stages of their own.
+        """
+        stages = []
+        tests = []
+        for f in filters + [None]:
+            p = f and f.predicate()
+            if p:
+                tests.append((f.cost, p))
+                continue
+            if tests:
+                tests.sort(key=lambda t: t[0])
+                stages.append(functools.partial(itertools.ifilter, all_of([ test for _, test in tests ])))
+                tests = []
+            if f:
+                stages.append(f.filter)
+        return stages
+
+    @staticmethod
+    def _split_server_filters(filters):
+        """Split filters into EC2 DescribeInstances filters and those left to apply locally."""
+        server = {}
+        local = []
+        for n, f in enumerate(filters):
+            if isinstance(f, OrderFilter) and f.count is not None:
+                # later filters apply to what it picks, so they must stay local too
+                local.extend(filters[n:])
+                break
+            sf = f.server_filter()
+            if sf is None or set(sf) & set(server):
+                local.append(f)
+            else:
+                server.update(sf)
+        return server, local
     
     def limit(self, *args):
         return Filters(self + list(args))
@@ -249,69 +1403,562 @@ class Filters(list):
     def __str__(self):
         return ' '.join( str(f) for f in self )
 
-def wraps(source):
-    def _wrapper(dest):
-        dest.__doc__ = source.__doc__
-        return dest
-    return _wrapper
+######################################################
+# Instance records
+######################################################
+
+# DescribeInstances elements copied as they are, to InstanceRecord fields
+RECORD_TEXT_FIELDS = {
+    'instanceId': 'id',
+    'imageId': 'image_id',
+    'privateDnsName': 'private_dns_name',
+    'dnsName': 'public_dns_name',
+    'keyName': 'key_name',
+    'amiLaunchIndex': 'ami_launch_index',
+    'instanceType': 'instance_type',
+    'launchTime': 'launch_time',
+    'kernelId': 'kernel',
+    'ramdiskId': 'ramdisk',
+    'platform': 'platform',
+    'subnetId': 'subnet_id',
+    'vpcId': 'vpc_id',
+    'privateIpAddress': 'private_ip_address',
+    'ipAddress': 'ip_address',
+    'architecture': 'architecture',
+    'rootDeviceType': 'root_device_type',
+    'rootDeviceName': 'root_device_name',
+    'virtualizationType': 'virtualization_type',
+    'hypervisor': 'hypervisor',
+}
+# fields with few distinct values, which records share a copy of
+RECORD_SHARED_FIELDS = ('image_id', 'key_name', 'instance_type', 'kernel', 'ramdisk', 'platform', 'subnet_id', 'vpc_id',
+                        'architecture', 'root_device_type', 'root_device_name', 'virtualization_type', 'hypervisor')
+
+GroupRecord = collections.namedtuple('GroupRecord', 'id name')
+# named as boto's BlockDeviceType
+BlockDeviceRecord = collections.namedtuple('BlockDeviceRecord', 'volume_id status attach_time delete_on_termination')
+
+class InstanceRecord(object):
+    """The parts of a boto Instance iboto uses, parsed straight from DescribeInstances.
+
+    Holding a large fleet as these takes a fraction of the memory and parse
+    time of boto's Reservation/Instance objects. Anything else, such as
+    monitoring_state or get_console_output(), is answered by the boto
+    Instance, described afresh from EC2 the first time it is needed (see
+    fetch_boto_instances).
+    """
+    __slots__ = tuple(RECORD_TEXT_FIELDS.values()) + ('state', 'state_code', 'placement', 'groups',
+                                                     'block_device_mapping', 'tags', 'account', 'connection',
+                                                     '_instance')
+
+    def __init__(self, connection=None):
+        for name in InstanceRecord.__slots__:
+            setattr(self, name, None)
+        self.connection = connection
+        self.groups = []
+        self.block_device_mapping = {}
+        self.tags = {}
+
+    @classmethod
+    def from_instance(cls, inst):
+        """A record of inst, a boto Instance."""
+        i = cls(inst.connection)
+        for name in RECORD_TEXT_FIELDS.itervalues():
+            setattr(i, name, getattr(inst, name, None))
+        i.state, i.state_code, i.placement = inst.state, inst.state_code, inst.placement
+        i.groups = [ GroupRecord(getattr(g, 'id', None), g.name) for g in inst.groups ]
+        i.block_device_mapping = dict( (dev, BlockDeviceRecord(b.volume_id, b.status, b.attach_time, b.delete_on_termination))
+                                       for dev, b in (inst.block_device_mapping or {}).iteritems() )
+        i.tags = dict(inst.tags)
+        return i
+
+    @classmethod
+    def from_dict(cls, d, connection=None, shared=None):
+        """A record from as_dict() values, sharing values in shared (a dict) with other records."""
+        if shared is None:
+            shared = {}
+        i = cls(connection)
+        for name in RECORD_TEXT_FIELDS.itervalues():
+            setattr(i, name, d.get(name))
+        i.state, i.state_code, i.placement = d['state'], d['state_code'], d['placement']
+        i.groups = [ GroupRecord(*g) for g in d['groups'] ]
+        i.block_device_mapping = dict( (dev, BlockDeviceRecord(*b)) for dev, b in d['block_device_mapping'].iteritems() )
+        i.tags = d['tags']
+        for field in RECORD_SHARED_FIELDS + ('state', 'placement'):
+            v = getattr(i, field)
+            if v is not None:
+                setattr(i, field, shared.setdefault(v, v))
+        return i
+
+    def as_dict(self):
+        """The record as plain values, for JSON."""
+        d = dict( (name, getattr(self, name)) for name in RECORD_TEXT_FIELDS.itervalues() )
+        d.update(state=self.state, state_code=self.state_code, placement=self.placement, groups=self.groups,
+                 block_device_mapping=self.block_device_mapping, tags=self.tags)
+        return d
+
+    @property
+    def dns_name(self):
+        return self.public_dns_name
+
+    def copy_from(self, other):
+        """Take on the description in other, a fresher record of this instance."""
+        for name in InstanceRecord.__slots__:
+            if name not in ('account', '_instance'):
+                setattr(self, name, getattr(other, name))
+        self._instance = None
+
+    def update(self, validate=False):
+        """Re-describe the instance, returning its state."""
+        li = describe_instances(self.connection, instance_ids=[self.id])
+        if li:
+            self.copy_from(li[0])
+        elif validate:
+            raise ValueError('%s is not a valid Instance ID' % self.id)
+        return self.state
+
+    def __getattr__(self, name):
+        # only reached for attributes a record doesn't have
+        # (private names are left alone, so introspection doesn't go to EC2)
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if self._instance is None:
+            fetch_boto_instances([self])
+            if self._instance is None:
+                raise AttributeError('%s: %s is no longer listed by EC2' % (name, self.id))
+        return getattr(self._instance, name)
+
+    def __repr__(self):
+        return 'Instance:%s' % self.id
+
+def fetch_boto_instances(records):
+    """Describe records that haven't been from EC2 as boto Instances, kept as their _instance.
+
+    One call per connection per BATCH_SIZE instances. Records EC2 no
+    longer lists are left without.
+    """
+    groups = {}
+    for i in records:
+        if i._instance is None:
+            groups.setdefault(instance_key(i), []).append(i)
+    def _fetch(li):
+        by_id = dict( (i.id, i) for i in li )
+        for n in xrange(0, len(li), BATCH_SIZE):
+            ids = [ i.id for i in li[n:n+BATCH_SIZE] ]
+            for r in li[0].connection.get_all_instances(filters={'instance-id': ids}):
+                for inst in r.instances:
+                    by_id[inst.id]._instance = inst
+    list(pool.map(_fetch, groups.values()))
+
+def _parse_instance(item, ns, connection, shared):
+    i = InstanceRecord(connection)
+    strip = len(ns)
+    for child in item:
+        tag = child.tag[strip:]
+        field = RECORD_TEXT_FIELDS.get(tag)
+        if field:
+            setattr(i, field, child.text or '')
+        elif tag == 'instanceState':
+            state = child.findtext(ns + 'name')
+            i.state = shared.setdefault(state, state)
+            i.state_code = int(child.findtext(ns + 'code') or 0)
+        elif tag == 'placement':
+            zone = child.findtext(ns + 'availabilityZone')
+            i.placement = shared.setdefault(zone, zone)
+        elif tag == 'groupSet':
+            i.groups = [ GroupRecord(g.findtext(ns + 'groupId'), g.findtext(ns + 'groupName')) for g in child ]
+        elif tag == 'blockDeviceMapping':
+            for b in child:
+                ebs = b.find(ns + 'ebs')
+                if ebs is not None:
+                    i.block_device_mapping[b.findtext(ns + 'deviceName')] = BlockDeviceRecord(
+                        ebs.findtext(ns + 'volumeId'), ebs.findtext(ns + 'status'),
+                        ebs.findtext(ns + 'attachTime'), ebs.findtext(ns + 'deleteOnTermination') == 'true')
+        elif tag == 'tagSet':
+            i.tags = dict( (t.findtext(ns + 'key'), t.findtext(ns + 'value') or '') for t in child )
+    for field in RECORD_SHARED_FIELDS:
+        v = getattr(i, field)
+        if v is not None:
+            setattr(i, field, shared.setdefault(v, v))
+    return i
+
+def _parse_page(body, connection=None):
+    # (InstanceRecords, token for the next page or None)
+    from xml.etree import cElementTree
+    from cStringIO import StringIO
+    shared = {}
+    li = []
+    next_token = None
+    for _, el in cElementTree.iterparse(StringIO(body)):
+        if el.tag[-12:] == 'instancesSet':
+            ns = el.tag[:-12]
+            li.extend( _parse_instance(item, ns, connection, shared) for item in el )
+            el.clear()
+        elif el.tag[-9:] == 'nextToken':
+            next_token = el.text
+    return li, next_token
+
+def parse_instances(body, connection=None):
+    """InstanceRecords for the instances in a DescribeInstances response.
+
+    Each reservation's instances are dropped from the element tree once
+    read, so parsing a large response doesn't hold it all in memory.
+    """
+    return _parse_page(body, connection)[0]
+
+PAGE_SIZE = 1000 # instances per DescribeInstances page, the most EC2 allows
+
+def _describe(ec2, filters=None, instance_ids=None, max_results=None, next_token=None):
+    params = {}
+    if instance_ids:
+        ec2.build_list_params(params, instance_ids, 'InstanceId')
+    if filters:
+        ec2.build_filter_params(params, filters)
+    if max_results:
+        params['MaxResults'] = max_results
+    if next_token:
+        params['NextToken'] = next_token
+    response = ec2.make_request('DescribeInstances', params, verb='POST')
+    body = response.read()
+    if response.status != 200:
+        raise ec2.ResponseError(response.status, response.reason, body)
+    return _parse_page(body, ec2)
+
+def describe_instances(ec2, filters=None, instance_ids=None):
+    """DescribeInstances on ec2, returning InstanceRecords."""
+    return _describe(ec2, filters, instance_ids)[0]
+
+def describe_instance_pages(ec2, filters=None):
+    """DescribeInstances on ec2 a page of PAGE_SIZE at a time, yielding lists of InstanceRecords.
+
+    Falls back to a single page if the endpoint or API version doesn't
+    know MaxResults.
+    """
+    import boto.exception
+    try:
+        li, token = _describe(ec2, filters, max_results=PAGE_SIZE)
+    except boto.exception.EC2ResponseError, ex:
+        if ex.status != 400 or 'MaxResults' not in (ex.error_message or ''):
+            raise
+        li, token = _describe(ec2, filters)
+    yield li
+    while token:
+        li, token = _describe(ec2, filters, max_results=PAGE_SIZE, next_token=token)
+        yield li
+
+######################################################
+# Bulk actions
+######################################################
+
+# calls taking a list of instance ids, for the per-instance methods of the same name
+BULK_ACTIONS = {
+    'start': 'start_instances',
+    'stop': 'stop_instances',
+    'terminate': 'terminate_instances',
+    'reboot': 'reboot_instances',
+}
+BATCH_SIZE = 100 # most instance ids sent in one call
+
+def _bulk_call(batch, cmd, *args, **kwargs):
+    ec2 = batch[0].connection
+    ids = [ i.id for i in batch ]
+    if cmd == 'add_tag':
+        key, value = args
+        ec2.create_tags(ids, {key: value})
+        for i in batch:
+            i.tags[key] = value
+    elif cmd == 'remove_tag':
+        key, value = args
+        ec2.delete_tags(ids, {key: value})
+        for i in batch:
+            if value is None or i.tags.get(key) == value:
+                i.tags.pop(key, None)
+    elif cmd in BULK_ACTIONS:
+        updated = getattr(ec2, BULK_ACTIONS[cmd])(ids, *args, **kwargs)
+        if isinstance(updated, list):
+            by_id = dict( (u.id, u) for u in updated )
+            for i in batch:
+                if i.id in by_id:
+                    # a state change response only fills in the state
+                    i.state, i.state_code = by_id[i.id].state, by_id[i.id].state_code
+    else:
+        for i in batch:
+            getattr(i, cmd)(*args, **kwargs)
+
+def bulk_action(instances, cmd, *args, **kwargs):
+    """Apply cmd to instances of one connection in as few EC2 calls as possible.
+
+    Returns {instance: error} for the instances it failed on. EC2 rejects a
+    whole call if any instance in it is invalid, so a rejected batch is
+    retried one instance at a time to find the culprits.
+    """
+    import boto.exception
+    failed = {}
+    for n in xrange(0, len(instances), BATCH_SIZE):
+        batch = instances[n:n+BATCH_SIZE]
+        try:
+            _bulk_call(batch, cmd, *args, **kwargs)
+        except boto.exception.EC2ResponseError, ex:
+            if len(batch) == 1:
+                failed[batch[0]] = ex.error_message or str(ex)
+                continue
+            for i in batch:
+                failed.update(bulk_action([i], cmd, *args, **kwargs))
+        except Exception, ex:
+            failed.update( (i, str(ex)) for i in batch )
+    return failed
+
+def poll_volumes(pending, status, action, verb):
+    """Wait for volumes to reach status, calling action(volume, instance) on each as it does.
+
+    pending maps volume ids to the instance each belongs to. Every tick makes
+    one get_all_volumes call per connection, backing off while nothing
+    changes. Returns the number of volumes action succeeded on.
+    """
+    pending = dict(pending)
+    total = len(pending)
+    done = 0
+    interval = 0.5
+    while pending:
+        groups = {}
+        for vol_id, i in pending.iteritems():
+            groups.setdefault('%s:%s' % instance_key(i), []).append(vol_id)
+        describe = lambda key: pending[groups[key][0]].connection.get_all_volumes(groups[key])
+        ready = []
+        for key, volumes in pool.map(describe, groups, wait=True):
+            for vol in volumes:
+                if vol.status == status:
+                    ready.append(vol)
+                elif vol.status == 'error':
+                    warn('volume %s for %s failed\n' % (vol.id, pending.pop(vol.id).id))
+        for vol, _ in pool.map(lambda vol: action(vol, pending[vol.id]), ready, wait=True):
+            done += 1
+        for vol in ready:
+            del pending[vol.id]
+
+        if ready:
+            print '%d/%d volumes %s' % (done, total, verb)
+            interval = 0.5
+        elif pending:
+            time.sleep(interval)
+            interval = min(interval * 2, 8)
+    return done
+
+######################################################
+# Waiting
+######################################################
+
+WAIT_STATES = ('running', 'stopped', 'terminated', 'status-checks-ok')
+WAIT_AFTER = {'start': 'running', 'stop': 'stopped', 'terminate': 'terminated'}
+DEAD_STATES = ('shutting-down', 'terminated')
+# the states an instance passes through on its way to each of WAIT_STATES;
+# from any other it won't get there by itself
+WAIT_VIA = {'running': ('pending',), 'stopped': ('stopping',), 'terminated': ('shutting-down',),
+            'status-checks-ok': ('pending', 'running')}
+# seconds EC2 may go on reporting the state an instance was in before an action
+ACTION_SETTLE = 30
+
+def _poll_states(instances, state):
+    """Refresh instances of one connection, returning {instance: state}.
+
+    Filtering on instance-id rather than listing ids means instances EC2
+    doesn't list don't fail the call. They are reported as terminated, as
+    EC2 drops instances a while after terminating them, except those just
+    launched (still pending): EC2 may not list them yet, so they stay
+    pending unless waiting for terminated.
+    """
+    ec2 = instances[0].connection
+    by_id = dict( (i.id, i) for i in instances )
+    states = {}
+    for i in instances:
+        states[i] = 'pending' if i.state == 'pending' and state != 'terminated' else 'terminated'
+    running = []
+    for n in xrange(0, len(instances), BATCH_SIZE):
+        ids = [ i.id for i in instances[n:n+BATCH_SIZE] ]
+        for new in describe_instances(ec2, filters={'instance-id': ids}):
+            i = by_id[new.id]
+            i.copy_from(new)
+            states[i] = i.state
+            if i.state == 'running':
+                running.append(i.id)
+    if state == 'status-checks-ok':
+        for n in xrange(0, len(running), BATCH_SIZE):
+            for st in ec2.get_all_instance_status(instance_ids=running[n:n+BATCH_SIZE]):
+                if st.system_status.status == 'ok' and st.instance_status.status == 'ok':
+                    states[by_id[st.id]] = state
+    return states
+
+def wait_for(instances, state, timeout=None, quiet=False, settle=0):
+    """Wait for instances to reach state, one of WAIT_STATES.
+
+    Every tick makes one describe call per connection (per 100 instances),
+    backing off from 0.5 to 8 seconds while nothing changes. Returns a
+    Result of the instances that got there; any that won't (in a state
+    not on the way there, see WAIT_VIA, e.g. stopped or terminated while
+    waiting for running) or were not there after timeout seconds are in
+    its failed, as are those still pending if interrupted with Ctrl+C.
+
+    settle gives instances just acted on that many seconds to leave the
+    state they were in, as EC2 may report it for a while after the action.
+    """
+    if state not in WAIT_STATES:
+        raise UsageError, 'cannot wait for %s, choose from: %s' % (state, ', '.join(WAIT_STATES))
+    li = list(instances)
+    pending = set(li)
+    failed = {}
+    deadline = timeout and time.time() + timeout
+    settled = time.time() + settle
+    interval = 0.5
+    try:
+        while pending:
+            groups = {}
+            for i in pending:
+                groups.setdefault('%s:%s' % instance_key(i), []).append(i)
+            changed = False
+            for key, states in pool.map(lambda key: _poll_states(groups[key], state), groups, wait=True):
+                for i, s in states.iteritems():
+                    if s == state:
+                        pending.discard(i)
+                        changed = True
+                    elif s not in WAIT_VIA[state] and (s in DEAD_STATES or time.time() >= settled):
+                        pending.discard(i)
+                        failed[i] = 'instance is %s' % s
+            if changed and not quiet:
+                print '%d/%d instances %s' % (len(li) - len(pending) - len(failed), len(li), state)
+            if not pending:
+                break
+
+            if changed:
+                interval = 0.5
+            if deadline and time.time() + interval > deadline:
+                failed.update( (i, 'timed out (%s)' % i.state) for i in pending )
+                break
+            time.sleep(interval)
+            check_cancelled()
+            interval = min(interval * 2, 8)
+    except (KeyboardInterrupt, Cancelled):
+        failed.update( (i, 'interrupted (%s)' % i.state) for i in pending )
+    finally:
+        snapshots.invalidate_instances(li)
+    return Result([ i for i in li if i not in failed ], failed=failed)
+
+def confirm_action(cmd, li):
+    if len(li) > 1:
+        return ask_yes_no('This will %s %d instances, ok? (y/N)' % (cmd, len(li)), default='n')
+    return True
+
+def apply_action(li, cmd, *args, **kwargs):
+    """Apply cmd to the instances in li, a connection at a time in parallel, returning a Result.
+
+    wait, if set, waits for the instances to reach the state cmd leads to.
+    Ctrl+C stops making requests: instances not yet answered for are failed.
+    """
+    wait = kwargs.pop('wait', False)
+    groups = {}
+    for i in li:
+        groups.setdefault('%s:%s' % instance_key(i), []).append(i)
+    failed = {}
+    try:
+        answered = set()
+        unanswered = 'no response from %s'
+        try:
+            for key, errors in pool.map(lambda key: bulk_action(groups[key], cmd, *args, **kwargs), groups, wait=True):
+                answered.add(key)
+                failed.update(errors)
+        except KeyboardInterrupt:
+            unanswered = 'interrupted (%s may have been asked already)'
+        for key in set(groups) - answered:
+            failed.update( (i, unanswered % key) for i in groups[key] )
+    finally:
+        snapshots.invalidate_instances(li)
+    succeeded = [ i for i in li if i not in failed ]
+    if wait and succeeded:
+        waited = wait_for(succeeded, WAIT_AFTER[cmd], settle=ACTION_SETTLE)
+        succeeded = waited.evaluate()
+        failed.update(waited.failed)
+    return Result(succeeded, failed=failed)
 
 class MultiActions(object):
-    @wraps(boto.ec2.instance.Instance.start)
-    def start(self):
-        return self.limit(StateFilter.stopped)._on_all('start')
+    def start(self, wait=False):
+        """Start the stopped instances, waiting until running if wait is set."""
+        return self.limit(StateFilter.stopped)._on_all('start', wait=wait)
         
-    @wraps(boto.ec2.instance.Instance.stop)
-    def stop(self, force=False):
-        return self.limit(StateFilter.not_stopped)._on_all('stop')
+    def stop(self, force=False, wait=False):
+        """Stop the running instances.
+
+        :type force: bool
+        :param force: Forces the instances to stop
+
+        :type wait: bool
+        :param wait: Wait until the instances have stopped
+        """
+        return self.limit(StateFilter.not_stopped)._on_all('stop', force=force, wait=wait)
         
-    @wraps(boto.ec2.instance.Instance.terminate)
-    def terminate(self):
-        return self.limit(StateFilter.not_terminated)._on_all('terminate')
+    def terminate(self, wait=False):
+        """Terminate the instances, waiting until terminated if wait is set."""
+        return self.limit(StateFilter.not_terminated)._on_all('terminate', wait=wait)
+
+    def wait(self, state='running', timeout=None):
+        """Wait for the instances to reach state, see wait_for."""
+        return wait_for(self._checked(), state, timeout)
         
-    @wraps(boto.ec2.instance.Instance.reboot)
     def reboot(self):
+        """Reboot the running instances."""
         return self.limit(StateFilter.not_stopped)._on_all('reboot')
         
-    @wraps(boto.ec2.instance.Instance.add_tag)
     def add_tag(self, key, value):
+        """Add a tag to the instances.
+
+        :type key: str
+        :param key: The key or name of the tag being stored.
+
+        :type value: str
+        :param value: The value to store under the key.
+        """
         return self._on_all('add_tag', key, value)
         
-    @wraps(boto.ec2.instance.Instance.remove_tag)
     def remove_tag(self, key, value=''):
+        """Remove a tag from the instances.
+
+        :type key: str
+        :param key: The key or name of the tag being removed.
+
+        :type value: str
+        :param value: Only remove the tag if it has this value.
+        """
         return self._on_all('remove_tag', key, value)
         
     def add_volume(self, size, device):
         """Create and attach a volume to each instance.
         
         """
+        li = self._checked()
         print 'Creating and attaching volumes...'
-        n = 0
-        for i in self:
-            vol = i.connection.create_volume(size, i.placement)
-            vol.attach(i.id, device)
-            n += 1
-        print 'Created %d volumes' % n
+        try:
+            created = dict( (vol.id, i) for i, vol in
+                            pool.map(lambda i: i.connection.create_volume(size, i.placement), li, wait=True) )
+            attached = poll_volumes(created, 'available',
+                                    lambda vol, i: i.connection.attach_volume(vol.id, i.id, device),
+                                    'attached')
+        finally:
+            snapshots.invalidate_instances(li)
+        print 'Created %d volumes' % attached
             
     def delete_volume(self, device, force=False):
         """Detach and delete the volume from each instance."""
         print 'Detaching volumes...'
-        volumes = []
-        for i in self:
-            mapping = i.block_device_mapping
-            if device in mapping:
-                bd = mapping[device]
-                i.connection.detach_volume(bd.volume_id, i.id, device, force)
-                volumes.extend(i.connection.get_all_volumes([bd.volume_id]))
-        
-        while volumes:
-            for vol in volumes:
-                vol.update()
-                if vol.status == 'available':
-                    vol.delete()
-                    del volumes[volumes.index(vol)]
-                    
-            time.sleep(1)
+        li = [ i for i in self._checked() if device in i.block_device_mapping ]
+        try:
+            detach = lambda i: i.connection.detach_volume(i.block_device_mapping[device].volume_id, i.id, device, force)
+            detached = dict( (i.block_device_mapping[device].volume_id, i) for i, _ in pool.map(detach, li, wait=True) )
+            poll_volumes(detached, 'available', lambda vol, i: i.connection.delete_volume(vol.id), 'deleted')
+        finally:
+            snapshots.invalidate_instances(li)
         
+    def table(self, tags=None):
+        """The instances as a Table, with a column for each tag in tags, or all of them."""
+        return Table.build(self, tags)
+
     @property    
     def name(self):
         """Get the Name tag from instances"""
@@ -322,22 +1969,52 @@ class MultiActions(object):
         """Set the Name tag on instances"""
         return self.add_tag('Name', value)
         
+    def _checked(self):
+        """The instances to act on or connect to, never from a stale listing."""
+        return list(self)
+
     def _on_all(self, cmd, *args, **kwargs):
-        li = list(self)
-        if len(li) > 1:
-            answer = ask_yes_no('This will %s %d instances, ok? (y/N)' % (cmd, len(li)), default='n')
-            if not answer:
-                return
-        for i in li:
-            getattr(i, cmd)(*args, **kwargs)
-        return Result(li, 'success')
+        li = self._checked()
+        if confirm_action(cmd, li):
+            return apply_action(li, cmd, *args, **kwargs)
+
+    def _on_all_async(self, cmd, *args, **kwargs):
+        # confirm now, the background can't ask
+        li = self._checked()
+        if confirm_action(cmd, li):
+            return engine.submit('%s %d instances' % (cmd, len(li)), apply_action, li, cmd, *args, **kwargs)
+
+    def astart(self, wait=False):
+        """As start, in the background, returning a Future of the Result (or None if declined)."""
+        return self.limit(StateFilter.stopped)._on_all_async('start', wait=wait)
+
+    def astop(self, force=False, wait=False):
+        """As stop, in the background, returning a Future of the Result (or None if declined)."""
+        return self.limit(StateFilter.not_stopped)._on_all_async('stop', force=force, wait=wait)
+
+    def aterminate(self, wait=False):
+        """As terminate, in the background, returning a Future of the Result (or None if declined)."""
+        return self.limit(StateFilter.not_terminated)._on_all_async('terminate', wait=wait)
+
+    def await_state(self, state='running', timeout=None):
+        """As wait, in the background, returning a Future of the Result."""
+        li = self._checked()
+        return engine.submit('wait for %d instances %s' % (len(li), state), wait_for, li, state, timeout, True)
+
+    def alist(self):
+        """List the instances in the background, returning a Future of them as a Result."""
+        return engine.submit('list instances', lambda: Result(list(self)))
         
     def __getattr__(self, name):
         # credit to idea for this from:
         # http://www.elastician.com/2009/09/stupid-boto-tricks-1-cross-region.html
         results = []
         is_callable = False
-        for i in self:
+        li = list(self)
+        if not name.startswith('_') and name not in dir(InstanceRecord):
+            # in batches, rather than a call per instance
+            fetch_boto_instances(li)
+        for i in li:
             val = getattr(i, name)
             if callable(val):
                 is_callable = True
@@ -380,54 +2057,277 @@ class MultiActions(object):
             
             
     def __getitem__(self, i):
-        try:
-            it = iter(self)
-            while i > 0:
-                it.next()
-                i -= 1
-            return it.next()
-        except StopIteration:
-            raise IndexError, 'list index out of range'
+        return self.evaluate()[i]
 
     def __len__(self):
-        return len(list(iter(self)))
+        return len(self.evaluate())
     
 class Instances(MultiActions):
     def __init__(self, filters):
         self._filters = filters
+        self._evaluated = None
                 
     def __str__(self):
-        return ', '.join( i.id for i in self._filters.resolve() )
+        return ', '.join( i.id for i in self )
         
     def __repr__(self):
         return 'Instances(limit=%s)' % str(self._filters)
         
     def __iter__(self):
-        return self._filters.resolve()
+        token = self._token()
+        if self._evaluated and self._evaluated[0] == token:
+            return iter(self._evaluated[1])
+        return self._stream(token)
+
+    def _token(self):
+        return (prompt_count, snapshots.generation, tuple(self._filters))
+
+    def _stream(self, token):
+        # yield instances as they are listed, keeping the list if it is finished
+        li = []
+        for i in self._filters.resolve():
+            li.append(i)
+            yield i
+        self._evaluated = (token, li)
+
+    def evaluate(self, force=False):
+        """List the selected instances, reusing the list until the next prompt.
+
+        The list is also redone if the filters change or instances are
+        modified through iboto.
+        """
+        token = self._token()
+        if force or not self._evaluated or self._evaluated[0] != token:
+            self._evaluated = (token, list(self._filters.resolve()))
+        return self._evaluated[1]
+
+    def refresh(self):
+        """Re-query AWS for the selected instances."""
+        if isinstance(self._filters[0], ConnectionList):
+            snapshots.invalidate(c.key for c in self._filters[0])
+        self.evaluate(force=True)
+        return self
+
+    def watch(self, fields=None, interval=2, steady_interval=10):
+        """Watch the selected instances for changes, see Watcher."""
+        return Watcher(self._filters, fields or WATCH_FIELDS, interval, steady_interval)
 
     def limit(self, *args):
         return Instances(self._filters.limit(*args))
 
-class Result(MultiActions):
-    def __init__(self, instances, status):
-        self._instances = instances
-        self._status = status
-        
-    def __iter__(self):
-        return iter(self._instances)
-        
+    def _checked(self):
+        return list(self._filters.resolve(checked=True))
+
+class Result(MultiActions):
+    def __init__(self, instances, status=None, failed=None):
+        self._instances = instances
+        self.failed = failed or {}
+        if status is None:
+            if not self.failed:
+                status = 'success'
+            elif instances:
+                status = 'partial'
+            else:
+                status = 'failed'
+        self._status = status
+        
+    def __iter__(self):
+        return iter(self._instances)
+
+    def evaluate(self):
+        return self._instances
+        
+    def instances(self):
+        return iter(self._instances)
+        
+    def limit(self, *args):
+        f = Filters([self])
+        return Instances(f).limit(*args)
+        
+    def __bool__(self):
+        return (self._status == 'success')
+        
+    def __repr__(self):
+        s = '<Result: %s, Instances: %s' % (self._status, ', '.join( i.id for i in self._instances ) or 'None')
+        if self.failed:
+            s += ', Failed: %s' % ', '.join( '%s (%s)' % (i.id, e) for i, e in self.failed.iteritems() )
+        return s + '>'
+
+######################################################
+# Tables
+######################################################
+
+# the columns of every table, before one per tag
+TABLE_COLUMNS = [
+    ('id', lambda i: i.id),
+    ('account', lambda i: i.account),
+    ('region', lambda i: i.connection.region.name),
+    ('zone', lambda i: i.placement),
+    ('type', lambda i: i.instance_type),
+    ('state', lambda i: i.state),
+    ('ami', lambda i: i.image_id),
+    ('launch_time', lambda i: i.launch_time),
+]
+
+def _numpy():
+    try:
+        import numpy
+        return numpy
+    except ImportError:
+        return None
+
+class Column(object):
+    """A table column: codes, an array with a code per row, indexing labels, the distinct values.
+
+    codes is a numpy array if numpy is installed, else an array.array.
+    """
+    def __init__(self, codes, labels):
+        self.codes = codes
+        self.labels = labels
+
+    @classmethod
+    def encode(cls, values, np=None):
+        import array
+        index = {}
+        codes = array.array('l', [ index.setdefault(v, len(index)) for v in values ])
+        labels = [None] * len(index)
+        for v, n in index.iteritems():
+            labels[n] = v
+        if np:
+            codes = np.frombuffer(codes, dtype=np.int_)
+        return cls(codes, labels)
+
+    def matching(self, test):
+        """Codes of the labels test(label) is true of."""
+        return [ n for n, label in enumerate(self.labels) if test(label) ]
+
+    def take(self, rows, np=None):
+        import array
+        if np:
+            return Column(self.codes[rows], self.labels)
+        return Column(array.array('l', [ self.codes[r] for r in rows ]), self.labels)
+
+    def values(self):
+        labels = self.labels
+        return [ labels[c] for c in self.codes ]
+
+def _condition(value):
+    # a test of labels, from a value, collection of values or function
+    if callable(value):
+        return value
+    if isinstance(value, (list, tuple, set, frozenset)):
+        values = set(value)
+        return lambda label: label in values
+    return lambda label: label == value
+
+class Table(object):
+    """Instances as columns, for filtering and counting them without visiting each in Python.
+
+    Columns are those of TABLE_COLUMNS, then one per tag (named by the tag,
+    unless a column has the name already), each held as codes into its
+    distinct values. So where() and count() test each distinct value once
+    and then work on arrays of integers: with numpy if it is installed,
+    array.array otherwise.
+
+      t = I.table()
+      t.where(type='m1.large', state='running').count('account', 'zone')
+      t.where(Role=['web', 'app'], launch_time=lambda t: t < '2012-06').instances().stop()
+    """
+    def __init__(self, instances, columns):
+        self._instances = instances
+        self._columns = columns
+        self._np = _numpy()
+
+    @classmethod
+    def build(cls, instances, tags=None):
+        """A table of instances, with a column per tag in tags, or for every tag if not given."""
+        np = _numpy()
+        instances = list(instances)
+        columns = collections.OrderedDict()
+        for name, value_of in TABLE_COLUMNS:
+            columns[name] = Column.encode([ value_of(i) for i in instances ], np)
+        if tags is None:
+            tags = sorted(set( k for i in instances for k in i.tags ))
+        for tag in tags:
+            if tag not in columns:
+                columns[tag] = Column.encode([ i.tags.get(tag) for i in instances ], np)
+        return cls(instances, columns)
+
+    @property
+    def columns(self):
+        return self._columns.keys()
+
+    def _column(self, name):
+        if name not in self._columns:
+            raise UsageError, 'no column %s, choose from: %s' % (name, ', '.join(self._columns))
+        return self._columns[name]
+
+    def __len__(self):
+        return len(self._instances)
+
+    def __getitem__(self, name):
+        """The values of a column, a row each."""
+        return self._column(name).values()
+
+    def where(self, **conditions):
+        """A table of the rows matching every condition.
+
+        Each condition is column=value, a list (or set) of values any of
+        which may match, or a function given each value returning whether
+        it matches. Untagged instances have the value None.
+        """
+        np = self._np
+        tests = [ (self._column(name), _condition(value)) for name, value in conditions.iteritems() ]
+        if np:
+            mask = np.ones(len(self), dtype=bool)
+            for col, test in tests:
+                mask &= np.in1d(col.codes, col.matching(test))
+            rows = np.nonzero(mask)[0]
+        else:
+            rows = xrange(len(self))
+            for col, test in tests:
+                wanted, codes = set(col.matching(test)), col.codes
+                rows = [ r for r in rows if codes[r] in wanted ]
+        instances = [ self._instances[r] for r in rows ]
+        columns = collections.OrderedDict( (name, col.take(rows, np)) for name, col in self._columns.iteritems() )
+        return Table(instances, columns)
+
+    def count(self, *names):
+        """Count the rows by the values of the named columns, as a Counter.
+
+        Keys are values for one column, or tuples of values for several.
+        """
+        np = self._np
+        cols = [ self._column(name) for name in names ]
+        if not cols or not len(self):
+            return collections.Counter()
+        counts = None
+        if np:
+            # one integer per combination of codes, counted at once
+            dims = [ len(col.labels) for col in cols ]
+            try:
+                keys = np.ravel_multi_index([ col.codes for col in cols ], dims)
+            except ValueError:
+                pass # more combinations than an integer holds
+            else:
+                uniq, n = np.unique(keys, return_counts=True)
+                counts = itertools.izip(itertools.izip(*np.unravel_index(uniq, dims)), n.tolist())
+        if counts is None:
+            counts = collections.Counter(itertools.izip(*[ col.codes for col in cols ])).iteritems()
+        res = collections.Counter()
+        for combo, n in counts:
+            values = tuple( col.labels[c] for col, c in zip(cols, combo) )
+            if len(values) == 1:
+                values = values[0]
+            res[values] = n
+        return res
+
     def instances(self):
-        return iter(self._instances)
-        
-    def limit(self, *args):
-        f = Filters([self])
-        return Instances(f).limit(*args)
-        
-    def __bool__(self):
-        return (self._status == 'success')
-        
+        """The instances in the table, as a Result to act on."""
+        return Result(self._instances)
+
     def __repr__(self):
-        return '<Result: %s, Instances: %s>' % (self._status, ', '.join( i.id for i in self._instances ) or 'None')
+        return '<Table: %d instances, columns: %s>' % (len(self), ', '.join(self._columns))
 
 # TODO better exception handling in completers
 # TODO handle spaces in tags (completion)
@@ -437,18 +2337,36 @@ class Result(MultiActions):
 # Helper functions
 ######################################################
 
+def iboto_path(*names):
+    return os.path.join(os.getenv('HOME'), '.iboto', *names)
+
+def write_file(path, data):
+    """Replace the file at path with data, creating its directory if need be."""
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with file(tmp, 'w') as fout:
+        fout.write(data)
+    os.rename(tmp, path)
+
+def store_path(backend):
+    """The fleet store database for backend, see FleetStore."""
+    if backend == 'aws':
+        return iboto_path('fleet.db')
+    return iboto_path('fleet-%s.db' % to_slug(backend))
+
+def format_age(seconds):
+    for unit, n in (('d', 24 * 60 * 60), ('h', 60 * 60), ('m', 60)):
+        if seconds >= n:
+            return '%d%s' % (seconds // n, unit)
+    return '%ds' % seconds
+
 re_allowed_chars = re.compile(r'[^a-z0-9_]+')
 def to_slug(n):
     n = n.lower()
     n = re_allowed_chars.sub('_', n)
     return n
 
-def firstinstance(reservations):
-    for r in reservations:
-        for i in r.instances:
-            return i
-    return None
-
 def allinstances(reservations):
     for r in reservations:
         for i in r.instances:
@@ -468,12 +2386,11 @@ class AMI(object):
         self.aki = aki
         self.virt = virt
 
+AMI_PLATFORMS = ['lucid', 'maverick', 'natty', 'oneiric', 'precise']
+AMI_TTL = 24 * 60 * 60 # seconds before a cached catalogue is revalidated
+AMI_DIR = os.path.join(os.path.dirname(__file__), 'ami') # bundled fallback maps
+
 class Catalogue(list):
-    def filter(self, attr):
-        for ami in self:
-            if not [ True for k, v in attr.iteritems() if getattr(ami, k, None) != v ]:
-                yield ami
-            
     @classmethod
     def instance(cls):
         inst = cls()
@@ -484,12 +2401,47 @@ class Catalogue(list):
         return set([ a.name for a in self ])
 
 class UbuntuAMICatalogue(Catalogue):
+    url = 'http://uec-images.ubuntu.com/query/%s/server/released.current.txt'
+
     def __init__(self, platform):
-        self.fetch(platform)
+        self.parse(self.fetch(platform))
         
     def fetch(self, platform):
-        resp = urllib2.urlopen('http://uec-images.ubuntu.com/query/%s/server/released.current.txt' % platform)
-        for line in resp.read().split('\n'):
+        """The catalogue text, cached under ~/.iboto/amis for AMI_TTL seconds.
+
+        A stale copy is revalidated with If-Modified-Since, and still used if
+        the catalogue cannot be downloaded.
+        """
+        import urllib2
+        import email.utils
+        path = iboto_path('amis', '%s.txt' % platform)
+        cached = None
+        if os.path.exists(path):
+            cached = file(path).read()
+            mtime = os.path.getmtime(path)
+            if time.time() - mtime < AMI_TTL:
+                return cached
+
+        req = urllib2.Request(self.url % platform)
+        if cached is not None:
+            req.add_header('If-Modified-Since', email.utils.formatdate(mtime, usegmt=True))
+        try:
+            text = urllib2.urlopen(req, timeout=30).read()
+        except urllib2.HTTPError, ex:
+            if cached is None or ex.code != 304:
+                raise
+            os.utime(path, None)
+            return cached
+        except (urllib2.URLError, socket.error), ex:
+            if cached is None:
+                raise
+            warn('could not revalidate %s AMIs (%s), using cached list\n' % (platform, ex))
+            return cached
+        write_file(path, text)
+        return text
+
+    def parse(self, text):
+        for line in text.split('\n'):
             if not line:
                 continue
             vs = line.split('\t')
@@ -510,21 +2462,48 @@ class Singleton(type):
             cls.instance = super(Singleton, cls).__call__(*args, **kw)
         return cls.instance
 
+class BundledAMICatalogue(Catalogue):
+    """AMIs from a map shipped with iboto, e.g. ami/ubuntu-lucid.cfg."""
+    def __init__(self, platform, filename):
+        import ConfigParser
+        cfg = ConfigParser.RawConfigParser()
+        cfg.read(filename)
+        for region in cfg.sections():
+            for key, ami in cfg.items(region):
+                # e.g. ubuntu_lucid_64_ebs
+                parts = key.split('_')
+                arch = parts[2] == '64' and 'x86_64' or 'i386'
+                store = parts[3:] == ['ebs'] and 'ebs' or 'instance-store'
+                self.append(AMI(ami, platform, store, arch, region, None, 'paravirtual'))
+
+def load_catalogue(platform):
+    import urllib2
+    try:
+        return UbuntuAMICatalogue(platform)
+    except (urllib2.URLError, socket.error), ex:
+        bundled = os.path.join(AMI_DIR, 'ubuntu-%s.cfg' % platform)
+        if not os.path.exists(bundled):
+            raise
+        warn('could not fetch %s AMIs (%s), using bundled list\n' % (platform, ex))
+        return BundledAMICatalogue(platform, bundled)
+
 class AllAMIs(object):
     __metaclass__ = Singleton
     
     def __init__(self):
-        self.catalogues = [UbuntuAMICatalogue('lucid'),
-                           UbuntuAMICatalogue('maverick'),
-                           UbuntuAMICatalogue('natty'),
-                           UbuntuAMICatalogue('oneiric'),
-                           UbuntuAMICatalogue('precise'),
-                        ]
-    
-    def filter(self, attr):
+        self.catalogues = [ cat for _, cat in pool.map(load_catalogue, AMI_PLATFORMS, ordered=True) ]
+        # (region, arch, store) -> {name: [ami, ...]}
+        self.index = {}
         for cat in self.catalogues:
-            for ami in cat.filter(attr):
-                yield ami
+            for ami in cat:
+                self.index.setdefault((ami.region, ami.arch, ami.store), {}).setdefault(ami.name, []).append(ami)
+    
+    def lookup(self, region, arch, store, name=None):
+        """AMIs by region, arch, store and name, or a {name: [ami, ...]} map if name is None."""
+        names = self.index.get((region, arch, store), {})
+        if name is None:
+            return names
+        return names.get(name, [])
                 
     def names(self):
         names = set()
@@ -532,15 +2511,15 @@ class AllAMIs(object):
             names.update(cat.names())
         return sorted(names)
         
+def ami_store(ebs):
+    return ebs == 'yes' and 'ebs' or 'instance-store'
+
 def resolve_ami(region, arg, attrs):
     amiid = None
     if arg.startswith('ami-'):
         return arg
     else:
-        attrs['name'] = arg
-        attrs['region'] = region
-        all_amis = AllAMIs()
-        amis = list(all_amis.filter(attrs))
+        amis = AllAMIs().lookup(region, attrs['arch'], attrs['store'], arg)
         if len(amis) == 1:
             return amis[0].id
         elif len(amis) == 0:
@@ -583,7 +2562,6 @@ class _instance_count(object):
         return 'n or n-m'
 instance_count = _instance_count()
 
-import readline
 class PromptCompleter(object):
     def __init__(self, completions):
         self.completions = completions
@@ -595,6 +2573,7 @@ class PromptCompleter(object):
         return None
 
 def prompt(p, validate=None, allow_blank=False, default=None, choices=None):
+    import readline
     while True:
         if choices:
             cp = PromptCompleter(choices)
@@ -694,7 +2673,12 @@ class Parameters(object):
         arg = cmd_param.pop()
         for o in self.options:
             if arg in o.opts:
-                return o.choices({})
+                # choices may depend on options given earlier on the line
+                try:
+                    opts, _ = self.parser().parse_args(cmd_param[1:])
+                    return [ str(c) for c in o.choices(opts.__dict__) or [] ]
+                except (ValueError, KeyError):
+                    return []
 
         params = self.all_opts()
         # drop from params any already used
@@ -749,27 +2733,36 @@ class EC2RunContext(object):
         return l
     
     def regions(self, ctx):
-        global iboto
         r = []
-        for c in iboto.connections():
-            if c.account.name == ctx['account']:
+        for c in self._connections(ctx, region=False):
+            if c.region not in r:
                 r.append(c.region)
         return r
     
-    def _connection(self, ctx):
+    def _connections(self, ctx, region=True):
+        # account or region may not be chosen yet (e.g. when completing),
+        # in which case all selected ones match
         global iboto
-        for c in iboto.connections():
-            if c.account.name == ctx['account'] and c.region == ctx['region']:
-                return c
+        return [ c for c in iboto.connections()
+                 if ctx.get('account') in (None, c.account.name)
+                 and (not region or ctx.get('region') in (None, c.region)) ]
+
+    def _metadata(self, ctx, what):
+        li = []
+        for c in self._connections(ctx):
+            for x in launch_metadata.get(c, what):
+                if x not in li:
+                    li.append(x)
+        return li
     
     def security_groups(self, ctx):
-        return [ g.name for g in self._connection(ctx).ec2.get_all_security_groups() ]
+        return self._metadata(ctx, 'security_groups')
         
     def keypairs(self, ctx):
-        return [ k.name for k in self._connection(ctx).ec2.get_all_key_pairs() ]
+        return self._metadata(ctx, 'keypairs')
         
     def zones(self, ctx):
-        return [ z.name for z in self._connection(ctx).ec2.get_all_zones() ]
+        return self._metadata(ctx, 'zones')
         
     def archs(self, ctx):
         return SIZE_ARCHS[ ctx['instance_type'] ]
@@ -782,14 +2775,88 @@ class EC2RunContext(object):
             
     def amis(self, ctx):
         # limit ami list to those with available region/arch/store
-        amis = AllAMIs().filter({'region': ctx['region'],
-                                 'arch': ctx['arch'],
-                                 'store': (ctx['ebs'] and 'ebs' or 'instance')})
-        li = list(set( a.name for a in amis ))
-        li.sort()
+        li = sorted(AllAMIs().lookup(ctx['region'], ctx['arch'], ami_store(ctx['ebs'])))
         li.append(AMIMatch())
         return li
 
+METADATA_TTL = 60 * 60 # seconds before launch metadata is refetched
+
+class LaunchMetadata(object):
+    """Security groups, key pairs and zones per account/region, for ec2run.
+
+    Kept in a file shared between sessions. Stale entries are still answered
+    from while they are refetched in the background, so only an account/region
+    never seen before waits on the network. Each is refetched once at a time,
+    however often it is asked for meanwhile.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._entries = None
+        self._fetching = set()
+        self._lock = threading.RLock()
+
+    def _load(self):
+        try:
+            return json.load(file(self.path))
+        except (IOError, ValueError):
+            return {}
+
+    def _save(self):
+        # merge with what other sessions have written since we loaded
+        entries = self._load()
+        for key, entry in self._entries.iteritems():
+            if key not in entries or entries[key]['time'] < entry['time']:
+                entries[key] = entry
+        self._entries = entries
+        write_file(self.path, json.dumps(entries))
+
+    def _entry(self, conn):
+        with self._lock:
+            if self._entries is None:
+                self._entries = self._load()
+            return self._entries.get(str(conn))
+
+    def stale(self, conn):
+        entry = self._entry(conn)
+        return not entry or time.time() - entry['time'] > METADATA_TTL
+
+    def fetch(self, conn):
+        ec2 = conn.ec2
+        entry = {'time': time.time(),
+                 'security_groups': [ g.name for g in ec2.get_all_security_groups() ],
+                 'keypairs': [ k.name for k in ec2.get_all_key_pairs() ],
+                 'zones': [ z.name for z in ec2.get_all_zones() ]}
+        with self._lock:
+            self._entry(conn)
+            self._entries[str(conn)] = entry
+            self._save()
+        return entry
+
+    def get(self, conn, what):
+        entry = self._entry(conn)
+        if not entry:
+            entry = self.fetch(conn)
+        elif self.stale(conn):
+            self.warm([conn])
+        return entry[what]
+
+    def _refetch(self, conn):
+        try:
+            return self.fetch(conn)
+        finally:
+            with self._lock:
+                self._fetching.discard(str(conn))
+
+    def warm(self, connections):
+        """Refetch stale entries for connections in the background, unless already being refetched."""
+        with self._lock:
+            stale = [ c for c in connections if str(c) not in self._fetching and self.stale(c) ]
+            self._fetching.update( str(c) for c in stale )
+        if stale:
+            in_background(lambda: list(pool.map(self._refetch, stale)))
+
+launch_metadata = LaunchMetadata(iboto_path('metadata.json'))
+
 class AMIMatch(object):
     def __eq__(self, x):
         return bool(re_ami.match(x))
@@ -816,6 +2883,7 @@ class EC2RunParameters(Parameters):
         Option(['--ebs'], default='yes', dest='ebs', prompt=True, metavar='EBS', choices=context.ebss, help='EBS or not.'),
         Option(['--ami'], dest='ami', prompt=True, metavar='AMI', choices=context.amis, help='AMI to launch'),
         Option(['-T', '--tags'], metavar='TAG', action='append', default=Option.missing, help='Add a tag to the launched instance.'),
+        Option(['-w', '--wait'], action='store_true', default=Option.missing, help='Wait until the instance(s) are running.'),
     ]
         
 class CustomOptionParser(optparse.OptionParser):
@@ -850,22 +2918,35 @@ def ec2run(self, parameter_s):
     ebs = run_args.pop('ebs')
     aminame = run_args.pop('ami')
     tags = run_args.pop('tags', None)
+    wait = run_args.pop('wait', False)
         
-    run_args['image_id'] = resolve_ami(region, aminame, {'arch': arch, 'store': (ebs == 'yes' and 'ebs' or 'instance')})
+    run_args['image_id'] = resolve_ami(region, aminame, {'arch': arch, 'store': ami_store(ebs)})
     r = connection.ec2.run_instances(**run_args)
+    snapshots.invalidate([connection.key])
+    li = [ InstanceRecord.from_instance(i) for i in allinstances([r]) ]
+    for i in li:
+        i.account = connection.account.name
     
+    failed = {}
     if tags:
         for tag in tags:
             if ':' in tag:
-                for i in allinstances([r]):
-                    key, value = tag.split(':', 1)
-                    i.add_tag(key, value)
+                key, value = tag.split(':', 1)
+                for i, error in bulk_action(li, 'add_tag', key, value).iteritems():
+                    failed[i] = 'launched, but not tagged %s (%s)' % (tag, error)
             else:
                 print 'Ignoring tag %s' % tag
+    if failed:
+        warn('%d of %d instance(s) not tagged, see the Result\n' % (len(failed), len(li)))
     
-    inst = firstinstance([r])
+    inst = li[0]
     iboto.add_filter(AttributeFilter('id', inst.id))
-    return Result([inst], 'success')
+    if wait:
+        waited = wait_for(li, 'running')
+        for i, error in failed.iteritems():
+            waited.failed.setdefault(i, error)
+        return Result([ i for i in waited.evaluate() if i not in failed ], failed=waited.failed)
+    return Result([ i for i in [inst] if i not in failed ], failed=failed)
 
 ec2run.__doc__ = ec2run_parameters.usage()
 
@@ -879,19 +2960,138 @@ def args_instances(parameter_s):
     return instances
 
 ######################################################
-# magic ec2ssh
+# magic ec2probe
 ######################################################
 
-re_user = re.compile('^(\w+@)')
+PROBE_MAX_SOCKETS = 512     # connects in flight at once
+
+def _connected(sockets, wait):
+    """The sockets whose connect has finished, one way or another, within wait seconds."""
+    import select
+    if hasattr(select, 'poll'):
+        # select fails on descriptors numbered past FD_SETSIZE, as they
+        # can be in a long session, however few are in flight
+        poller = select.poll()
+        by_fd = {}
+        for s in sockets:
+            poller.register(s, select.POLLOUT)
+            by_fd[s.fileno()] = s
+        return [ by_fd[fd] for fd, _ in poller.poll(wait * 1000) ]
+    _, writable, errored = select.select([], sockets, sockets, wait)
+    return set(writable + errored)
+
+def probe(targets, timeout=2.0):
+    """Try a TCP connect to every (address, port) in targets at once.
+
+    Returns {(address, port): status}, status being 'open', 'closed' if the
+    connect was refused or failed, 'timeout' if there was no answer within
+    timeout seconds, or 'no address' if the address is None or empty.
+    Addresses should be IPs, as a name lookup would block.
+    """
+    import errno
+    pending = list(set(targets))
+    results = dict( (t, 'no address') for t in pending if not t[0] )
+    pending = [ t for t in pending if t[0] ]
+    sockets = {}
+    while pending or sockets:
+        while pending and len(sockets) < PROBE_MAX_SOCKETS:
+            target = pending.pop()
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            s.setblocking(0)
+            try:
+                err = s.connect_ex(target)
+            except socket.error:
+                err = errno.EHOSTUNREACH
+            if err in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+                sockets[s] = (target, time.time() + timeout)
+            else:
+                results[target] = err == 0 and 'open' or 'closed'
+                s.close()
+        if not sockets:
+            continue
+
+        wait = max(min( d for _, d in sockets.itervalues() ) - time.time(), 0)
+        for s in _connected(sockets.keys(), wait):
+            target, _ = sockets.pop(s)
+            err = s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            results[target] = err == 0 and 'open' or 'closed'
+            s.close()
+        now = time.time()
+        for s, (target, deadline) in sockets.items():
+            if deadline <= now:
+                results[target] = 'timeout'
+                del sockets[s]
+                s.close()
+    return results
+
+def wait_for_port(address, port=22, confirm=1, interval=0.1, timeout=1.0):
+    """Block until address:port accepts a connect confirm times running.
+
+    Probes every interval seconds, so an opening port is seen promptly.
+    """
+    count = 0
+    while count < confirm:
+        if probe([(address, port)], timeout)[(address, port)] == 'open':
+            count += 1
+        else:
+            count = 0
+        time.sleep(interval)
+
+class ProbeMatrix(dict):
+    """Reachability of ports across instances, {instance id: {port: status}}.
+
+    Instances with no public address have a status of None.
+    """
+    def __init__(self, instances, ports, timeout=2.0):
+        super(ProbeMatrix, self).__init__()
+        self.instances = list(instances)
+        self.ports = list(ports)
+        results = probe([ (i.ip_address, p) for i in self.instances if i.ip_address for p in self.ports ], timeout)
+        for i in self.instances:
+            self[i.id] = dict( (p, results.get((i.ip_address, p))) for p in self.ports )
+
+    def reachable(self, port=22):
+        """Instances with port open."""
+        return [ i for i in self.instances if self[i.id][port] == 'open' ]
+
+    def __repr__(self):
+        format = '%-11s %-15s' + ' %-7s' * len(self.ports)
+        header = format % tuple(['instance', 'address'] + self.ports)
+        lines = [header, '=' * len(header)]
+        for i in self.instances:
+            lines.append(format % tuple([i.id, i.ip_address or '-'] + [ self[i.id][p] or '-' for p in self.ports ]))
+        return '\n'.join(lines)
+
+re_ports = re.compile(r'^\d+(,\d+)*$')
 
-def ssh_live(ip, port=22):
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+def ec2probe(self, parameter_s):
+    """Check which ports are reachable on the selected instances.
+
+    Usage:\\
+      %ec2probe [-t SECS] [port,...] [filter ...]
+
+    Connects to every port on every selected instance at once (default port
+    22), giving up on a port after -t seconds (default 2). Returns a
+    ProbeMatrix, shown as a table of open/closed/timeout per port, e.g.:
+      %ec2probe 22,80,443 Role:web
+      _.reachable(80)
+    """
+    parser = CustomOptionParser(add_help_option=False)
+    parser.add_option('-t', dest='timeout', type='float', default=2.0)
     try:
-        s.connect((ip, port))
-        s.shutdown(2)
-        return True
-    except:
-        return False
+        opts, args = parser.parse_args(parameter_s.split())
+    except ValueError, ex:
+        raise UsageError, str(ex)
+    ports = [22]
+    if args and re_ports.match(args[0]):
+        ports = [ int(p) for p in args.pop(0).split(',') ]
+    return ProbeMatrix(args_instances(' '.join(args))._checked(), ports, opts.timeout)
+
+######################################################
+# magic ec2ssh
+######################################################
+
+re_user = re.compile('^(\w+@)')
 
 def ec2ssh(self, parameter_s):
     """SSH to a running instance.
@@ -925,7 +3125,7 @@ def ec2ssh(self, parameter_s):
         username = m.group(1)
         qs = re_user.sub('', qs)
     
-    instances = list(args_instances(qs))
+    instances = args_instances(qs)._checked()
     if len(instances) > 1:
         raise UsageError, "%d instances found - ec2ssh only supports a single host" % len(instances)
     inst = instances[0]    
@@ -937,57 +3137,263 @@ def ec2ssh(self, parameter_s):
     try:
         if inst.state == 'pending':
             print 'Waiting for %s pending->running... (Ctrl+C to abort)' % inst.id
-            while inst.update() == 'pending':
-                time.sleep(1)
-    
-        if not ssh_live(inst.ip_address):
-            count = 0
+            waited = wait_for([inst], 'running', quiet=True)
+            if waited.failed:
+                print 'Failed, instance %s %s' % (inst.id, waited.failed[inst])
+                return
+
+        if inst.state != 'running':
+            print 'Failed, instance %s is not running (%s)' % (inst.id, inst.state)
+            return
+        host = inst.public_dns_name or inst.ip_address
+        if not host:
+            print 'Failed, instance %s has no public address' % inst.id
+            return
+
+        if inst.ip_address and probe([(inst.ip_address, 22)]).values() != ['open']:
             print 'Waiting for %s SSH port... (Ctrl+C to abort)' % inst.id
             # must succeed 3 times to be sure SSH is alive
-            while count < 3:
-                if ssh_live(inst.ip_address):
-                    count += 1
-                else:
-                    count = 0
-                time.sleep(1)
-                
-        if inst.state == 'running':
-            print 'Connecting to %s... (Ctrl+C to abort)' % inst.public_dns_name
-            ip.system('ssh %s %s%s' % (ssh_args, username, inst.public_dns_name))
-        else:
-            print 'Failed, instance %s is not running (%s)' % (inst.id, inst.state)
+            wait_for_port(inst.ip_address, 22, confirm=3)
+
+        print 'Connecting to %s... (Ctrl+C to abort)' % host
+        ip.system('ssh %s %s%s' % (ssh_args, username, host))
     except KeyboardInterrupt:
         pass
         
     return str(inst.id)
 
-def instance_completer_factory(filters={}):
+class CompletionIndex(object):
+    """Instance ids and Tag:Value strings of the selection, for TAB completion.
+
+    Kept as a sorted list of words per instance state, so completing a
+    prefix is a binary search. Once built, lookups are answered from memory
+    and a stale index is rebuilt in a background thread.
+    """
+    def __init__(self):
+        self._entry = None # (filters, time built, snapshot generation, {state: words})
+        self._build_lock = threading.Lock()
+
+    def _stale(self, entry):
+        return time.time() - entry[1] > snapshots.ttl or entry[2] != snapshots.generation
+
+    def build(self, filters):
+        with self._build_lock:
+            entry = self._entry
+            if entry and entry[0] == tuple(filters) and not self._stale(entry):
+                # built while we waited for the lock
+                return
+            built, generation = time.time(), snapshots.generation
+            words = {}
+            for i in filters.resolve():
+                w = words.setdefault(i.state, set())
+                w.add(i.id)
+                for k, v in i.tags.iteritems():
+                    w.add('%s:%s' % (k, v))
+            self._entry = (tuple(filters), built, generation,
+                           dict( (state, sorted(w)) for state, w in words.iteritems() ))
+
+    def refresh(self, filters):
+        """Rebuild the index for filters in the background."""
+        # if this fails, the next lookup will try again
+        in_background(self.build, filters)
+
+    def complete(self, filters, prefix, states=None):
+        """Words starting with prefix from instances in states (None for any)."""
+        filters = Filters(filters)
+        entry = self._entry
+        if not entry or entry[0] != tuple(filters):
+            self.build(filters)
+            entry = self._entry
+        elif self._stale(entry) and not self._build_lock.locked():
+            self.refresh(filters)
+
+        res = set()
+        for state, words in entry[3].iteritems():
+            if states is None or state in states:
+                n = bisect.bisect_left(words, prefix)
+                while n < len(words) and words[n].startswith(prefix):
+                    res.add(words[n])
+                    n += 1
+        return sorted(res)
+
+completions = CompletionIndex()
+
+def instance_completer_factory(states=None):
     def _completer(self, event):
         try:
             global iboto
-            res = []
-            for i in iboto.instances:
-                res.append(i.id)
-                for k, v in i.tags.iteritems():
-                    res.append('%s:%s' % (k, v))
-        
-            res.extend(STATES)
-            res.extend(ARCHS)
-            
-            return [ r for r in res if r.startswith(event.symbol) ]
+            res = completions.complete(iboto.filters, event.symbol, states)
+            res.extend( r for r in STATES + ARCHS if r.startswith(event.symbol) )
+            return res
         except Exception, ex:
             print ex
     return _completer
 
+######################################################
+# magic ec2pssh
+######################################################
+
+PSSH_SSH_ARGS = ['-o', 'BatchMode=yes', '-o', 'ConnectTimeout=10']
+
+# exit is None if the command timed out or ssh could not be started
+HostResult = collections.namedtuple('HostResult', 'instance host exit output elapsed')
+
+class PsshResult(list):
+    """HostResults from running a command across instances, one per host."""
+    def by_exit(self):
+        codes = {}
+        for r in self:
+            codes.setdefault(r.exit, []).append(r)
+        return codes
+
+    @property
+    def ok(self):
+        return [ r for r in self if r.exit == 0 ]
+
+    @property
+    def failed(self):
+        return [ r for r in self if r.exit != 0 ]
+
+    def summary(self):
+        s = []
+        for code, li in sorted(self.by_exit().iteritems()):
+            label = code is None and 'timeout/error' or 'exit %d' % code
+            if len(li) > 10:
+                s.append('%s: %d hosts' % (label, len(li)))
+            else:
+                s.append('%s: %s' % (label, ', '.join( r.instance.id for r in li )))
+        return '; '.join(s)
+
+    def __repr__(self):
+        return '<PsshResult: %d host(s), %d ok, %s>' % (len(self), len(self.ok), self.summary() or 'None')
+
+def pssh(instances, command, ssh_args=(), username='', parallel=None, timeout=60, stream=True):
+    """Run command over ssh on every instance, parallel hosts at a time.
+
+    Output lines are printed prefixed with the instance id as they arrive
+    unless stream is off; either way each host's output is kept in the
+    returned PsshResult. A host still running after timeout seconds is
+    killed and reported with an exit of None.
+    """
+    import subprocess
+    lock = threading.Lock()
+    width = max(len(i.id) for i in instances) if instances else 0
+    procs = []
+
+    def _kill(p, killed=None):
+        # ssh runs in its own process group so a ProxyCommand dies with it
+        try:
+            os.killpg(p.pid, signal.SIGKILL)
+            if killed is not None:
+                killed.append(True)
+        except OSError:
+            pass
+
+    def _run(inst):
+        host = inst.public_dns_name or inst.ip_address
+        if not host:
+            # e.g. in a VPC without a public address
+            return HostResult(inst, host, None, 'no address', 0.0)
+        start = time.time()
+        try:
+            p = subprocess.Popen(['ssh'] + PSSH_SSH_ARGS + list(ssh_args) + [username + host, command],
+                                 stdin=open(os.devnull), stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                 preexec_fn=os.setsid)
+        except OSError, ex:
+            return HostResult(inst, host, None, str(ex), 0.0)
+        procs.append(p)
+        killed = []
+        killer = threading.Timer(timeout, _kill, (p, killed))
+        killer.start()
+        output = []
+        for line in iter(p.stdout.readline, ''):
+            output.append(line)
+            if stream:
+                with lock:
+                    sys.stdout.write('%-*s | %s' % (width, inst.id, line))
+                    sys.stdout.flush()
+        p.wait()
+        killer.cancel()
+        return HostResult(inst, host, None if killed else p.returncode, ''.join(output), time.time() - start)
+
+    # each host enforces timeout itself, so the pool only needs to outlast them
+    hosts = Pool(parallel or pool.width, timeout + 10)
+    try:
+        return PsshResult( r for _, r in hosts.map(_run, instances, ordered=True) )
+    except KeyboardInterrupt:
+        for p in procs:
+            _kill(p)
+        raise
+
+def ec2pssh(self, parameter_s):
+    """Run a command on every selected running instance in parallel.
+
+    Usage:\\
+      %ec2pssh [-p N] [-t SECS] [-q] [-l user] [-i key] [-o opt] [filter ...] -- command
+
+    Without '--' everything after the options is the command, and it is
+    run on the current selection. Options:
+      -p N      hosts to run on at once (default IBoto.concurrency)
+      -t SECS   kill the command on a host after SECS seconds (default 60)
+      -q        don't print output as it arrives, just the summary
+      -l user   user to ssh in as
+      -i key    identity file, -o opt ssh option, both passed through to ssh
+
+    Output lines are prefixed with the instance id. A summary of exit codes
+    is printed at the end, and the PsshResult holding each host's output
+    and exit code is returned, e.g.:
+      %ec2pssh Role:web -- uptime
+      r = _; r.failed
+    """
+    if ' -- ' in ' %s ' % parameter_s:
+        opts_s, command = (' %s ' % parameter_s).split(' -- ', 1)
+    else:
+        opts_s, command = parameter_s, None
+    parser = CustomOptionParser(add_help_option=False)
+    parser.add_option('-p', dest='parallel', type='int')
+    parser.add_option('-t', dest='timeout', type='float', default=60)
+    parser.add_option('-q', dest='quiet', action='store_true', default=False)
+    parser.add_option('-l', dest='user', default='')
+    parser.add_option('-i', dest='identity')
+    parser.add_option('-o', dest='ssh_options', action='append', default=[])
+    parser.disable_interspersed_args()
+    try:
+        opts, args = parser.parse_args(opts_s.split())
+    except ValueError, ex:
+        raise UsageError, str(ex)
+    if command is None:
+        # no selection given, everything after the options is the command
+        command, args = ' '.join(args), []
+    if not command.strip():
+        raise UsageError, 'no command given'
+
+    ssh_args = []
+    if opts.identity:
+        ssh_args += ['-i', opts.identity]
+    for o in opts.ssh_options:
+        ssh_args += ['-o', o]
+
+    instances = args_instances(' '.join(args)).limit(StateFilter.running)._checked()
+    if not instances:
+        raise UsageError, 'no running instances selected'
+    print 'Running on %d instance(s)... (Ctrl+C to abort)' % len(instances)
+    try:
+        results = pssh(instances, command.strip(), ssh_args, opts.user and opts.user + '@',
+                       opts.parallel, opts.timeout, stream=not opts.quiet)
+    except KeyboardInterrupt:
+        return
+    print results.summary()
+    return results
+
 ######################################################
 # generic methods for ec2start, ec2stop, ec2kill
 ######################################################
 
 def _define_ec2cmd(ip, cmd, verb, state):
     if state:
-        filters = [AttributeFilter('state', state)]
+        states = [state]
     else:
-        filters = []
+        states = None
     
     def _ec2cmd(ip, parameter_s):
         instances = args_instances(parameter_s)
@@ -1014,7 +3420,7 @@ def _define_ec2cmd(ip, cmd, verb, state):
     ip.define_magic(cmd, fn)
 
     ip.set_hook('complete_command',
-                instance_completer_factory(filters=filters),
+                instance_completer_factory(states=states),
                 re_key = '%?'+cmd)
 
 def ec2din(self, parameter_s):
@@ -1026,60 +3432,174 @@ def ec2din(self, parameter_s):
     instances = args_instances(parameter_s)
     instances.ls()
 
+######################################################
+# magic ec2summary
+######################################################
+
+SUMMARY_COLUMNS = ['state', 'type', 'zone', 'account']
+
+def ec2summary(self, parameter_s):
+    """Count the selected instances by state, type, zone and account.
+
+    Usage:\\
+      %ec2summary [-b COLUMN[,COLUMN...]] [filter ...]
+
+    -b counts by each combination of the given columns instead, e.g.
+    -b account,type. Columns are those of I.table(): id, account, region,
+    zone, type, state, ami, launch_time, and tag names such as Role.
+    """
+    parser = CustomOptionParser(add_help_option=False)
+    parser.add_option('-b', dest='by')
+    try:
+        opts, args = parser.parse_args(parameter_s.split())
+    except ValueError, ex:
+        raise UsageError, str(ex)
+    if opts.by:
+        breakdowns = [opts.by.split(',')]
+    else:
+        breakdowns = [ [c] for c in SUMMARY_COLUMNS ]
+    # only the tag columns asked for are built
+    tags = set( c for names in breakdowns for c in names ) - set( c for c, _ in TABLE_COLUMNS )
+    table = args_instances(' '.join(args)).table(tags=sorted(tags))
+    print '%d instances' % len(table)
+    for names in breakdowns:
+        counts = table.count(*names).most_common()
+        if len(names) == 1:
+            counts = [ ((value,), n) for value, n in counts ]
+        rows = [ (' '.join( unicode(v) for v in values ), n) for values, n in counts ]
+        width = max([ len(' '.join(names)) ] + [ len(r) for r, _ in rows ])
+        print
+        print '%-*s %6s %5s' % (width, ' '.join(names), 'count', '%')
+        print '=' * (width + 13)
+        for r, n in rows:
+            print '%-*s %6d %4.0f%%' % (width, r, n, 100.0 * n / len(table))
+
+######################################################
+# magic ec2wait
+######################################################
+
+def ec2wait(self, parameter_s):
+    """Wait for the selected instances to reach a state.
+
+    Usage:\\
+      %ec2wait [-t SECS] running|stopped|terminated|status-checks-ok [filter ...]
+
+    Polls each account/region with one call per tick, backing off while
+    nothing changes, and gives up after -t seconds if given. Returns a
+    Result listing any instances that didn't make it. From Python use
+    I.wait('running', timeout=...), or e.g. I.start(wait=True).
+    """
+    parser = CustomOptionParser(add_help_option=False)
+    parser.add_option('-t', dest='timeout', type='float')
+    try:
+        opts, args = parser.parse_args(parameter_s.split())
+    except ValueError, ex:
+        raise UsageError, str(ex)
+    if not args:
+        raise UsageError, 'state required, one of: %s' % ', '.join(WAIT_STATES)
+    state = args.pop(0)
+    if state not in WAIT_STATES:
+        raise UsageError, 'cannot wait for %s, choose from: %s' % (state, ', '.join(WAIT_STATES))
+    instances = args_instances(' '.join(args))._checked()
+    print 'Waiting for %d instance(s) to be %s... (Ctrl+C to abort)' % (len(instances), state)
+    try:
+        return wait_for(instances, state, opts.timeout)
+    except KeyboardInterrupt:
+        pass
+
+def wait_completer(self, event):
+    # the first argument is the state, any further ones filters
+    args = event.line.split()
+    if event.line.endswith(' '):
+        args.append('')
+    if len(args) == 2:
+        return [ s for s in WAIT_STATES if s.startswith(event.symbol) ]
+    return instance_completer_factory()(self, event)
+
 ######################################################
 # magic ec2watch
 ######################################################
 
-def _watch_step(parameter_s, instances, monitor_fields):
-    new_instances = list(args_instances(parameter_s))
-    
-    n_i = new_instances[:]
-    id_i = [ i.id for i in n_i ]
-    for inst in instances:
-        if inst.id in id_i:
-            n = id_i.index(inst.id)
-                
-            # compare properties
-            changes = []
-            for k in monitor_fields:
-                v1 = getattr(inst, k)
-                v2 = getattr(n_i[n], k)
+WATCH_FIELDS = ['launch_time', 'instance_type', 'state', 'public_dns_name', 'private_ip_address']
+TRANSITIONAL_STATES = ('pending', 'stopping', 'shutting-down')
+
+# kind is 'added', 'removed' or 'changed'; field, old and new are set for changes
+WatchEvent = collections.namedtuple('WatchEvent', 'kind id field old new instance')
+
+class Watcher(object):
+    """Iterate over changes to the instances selected by filters.
+
+    Polls every interval seconds while any instance is changing state, and
+    every steady_interval seconds otherwise. current holds the latest
+    snapshot, mapping instance id to (instance, field values).
+    """
+    def __init__(self, filters, fields, interval=2, steady_interval=10):
+        self.filters = filters
+        self.fields = fields
+        self.interval = interval
+        self.steady_interval = steady_interval
+        self.current = self.snapshot()
+
+    def snapshot(self):
+        return dict( (i.id, (i, tuple(getattr(i, k, None) for k in self.fields)))
+                     for i in self.filters.resolve(fresh=True) )
+
+    def diff(self, old, new):
+        for id, (inst, values) in old.iteritems():
+            if id not in new:
+                yield WatchEvent('removed', id, None, None, None, inst)
+                continue
+            inst, new_values = new[id]
+            if new_values == values:
+                continue
+            for k, v1, v2 in zip(self.fields, values, new_values):
                 if v1 != v2:
-                    if v1:
-                        if v2:
-                            print ' %s  %s: %s->%s' % (inst.id, k, v1, v2)
-                        else:
-                            print ' %s -%s: %s' % (inst.id, k, v1)
-                    else:
-                        print ' %s +%s: %s' % (inst.id, k, v2)
+                    yield WatchEvent('changed', id, k, v1, v2, inst)
+        for id, (inst, values) in new.iteritems():
+            if id not in old:
+                yield WatchEvent('added', id, None, None, None, inst)
 
-            del id_i[n]
-            del n_i[n]
-        else:
-            # instance has gone
-            print '-%s' % inst.id
-            
-    # new instances
-    for i in n_i:
-        print '+%s' % i.id
+    def busy(self):
+        return [ i for i, _ in self.current.itervalues() if i.state in TRANSITIONAL_STATES ]
+
+    def __iter__(self):
+        while True:
+            time.sleep(self.busy() and self.interval or self.steady_interval)
+            new = self.snapshot()
+            for event in self.diff(self.current, new):
+                yield event
+            self.current = new
 
-    return new_instances
+    def __len__(self):
+        return len(self.current)
+
+def format_event(e):
+    if e.kind == 'added':
+        return '+%s' % e.id
+    elif e.kind == 'removed':
+        return '-%s' % e.id
+    elif not e.old:
+        return ' %s +%s: %s' % (e.id, e.field, e.new)
+    elif not e.new:
+        return ' %s -%s: %s' % (e.id, e.field, e.old)
+    else:
+        return ' %s  %s: %s->%s' % (e.id, e.field, e.old, e.new)
 
 def ec2watch(self, parameter_s):
     """Watch for changes in any properties on instances.
 
     Usage:\\
       %ec2watch [instance ...]
-    """
-    interval = 2
-    monitor_fields = ['launch_time', 'instance_type', 'state', 'public_dns_name', 'private_ip_address']
 
-    instances = list(args_instances(parameter_s))
-    print 'Watching %d instance(s) (press Ctrl+C to end)' % len(instances)
+    Polls every 2 seconds while instances are changing state, and every 10
+    seconds when they are steady. From Python use iboto.watch(...), which
+    yields the changes as WatchEvents.
+    """
+    watcher = args_instances(parameter_s).watch()
+    print 'Watching %d instance(s) (press Ctrl+C to end)' % len(watcher)
     try:
-        while True:
-            time.sleep(interval)
-            instances = _watch_step(parameter_s, instances, monitor_fields)
+        for event in watcher:
+            print format_event(event)
     except KeyboardInterrupt:
         pass
 
@@ -1132,47 +3652,117 @@ def magic_region(ip, parameter_s):
 def region_completers(self, event):
     return REGIONS
 
+# order the tests of a compiled filter run in, cheapest and most selective first
+MATCH_COSTS = {'exact': 1, 'startswith': 2, 'in': 3, 're': 4}
+
+def all_of(tests):
+    """A predicate true when every one of tests is, tried in order."""
+    if len(tests) == 1:
+        return tests[0]
+    def test(i):
+        for t in tests:
+            if not t(i):
+                return False
+        return True
+    return test
+
 class Filter(object):
+    cost = 5
+
     @staticmethod
-    def _matcher(value, mode):
+    def _matcher(values, mode):
+        """A test of an instance's value against any of values, as a single check however many."""
         if mode == 'startswith':
+            prefixes = tuple(values)
             def startswith(x):
                 if x is None:
                     return False
-                return x.startswith(value)
+                return x.startswith(prefixes)
             return startswith
         elif mode == 're':
-            r = re.compile(value)
+            r = re.compile('|'.join( '(?:%s)' % v for v in values ))
             def re_search(x):
                 if x is None:
                     return False
                 return r.search(x)
             return re_search
         elif mode == 'in':
+            names = frozenset(values)
             def in_fn(x):
                 if x is None:
                     return False
-                return [ g.name for g in x if g.name == value ]
+                return [ g.name for g in x if g.name in names ]
             return in_fn
         else:
-            return lambda x: x == value
+            values = frozenset(values)
+            return lambda x: x in values
+
+    @staticmethod
+    def _server_values(values):
+        # EC2 treats * and ? as wildcards, which an exact match must not
+        if [ v for v in values if re_wildcard.search(v) ]:
+            return None
+        return list(values)
+
+    def server_filter(self):
+        """The equivalent DescribeInstances filters, or None if only applied locally."""
+        return None
+
+    def predicate(self):
+        """A function true of the instances the filter selects, or None if it isn't a test of each alone."""
+        return None
     
     @property
     def type(self):
         return type(self).__name__
 
 class IterableFilter(Filter):
+    """Selects instances whose value_of() matches one of values according to mode."""
+    mode = 'exact'
+
     def filter(self, li):
         return itertools.ifilter(self.select, li)
 
+    def select(self, i):
+        return self.m(self.value_of(i))
+
+    def predicate(self):
+        return self.select
+
+    @property
+    def cost(self):
+        return MATCH_COSTS[self.mode]
+
 class AttributeFilter(IterableFilter):
     def __init__(self, attr, value, mode='exact'):
         self.attr = attr
         self.value = value
-        self.m = Filter._matcher(value, mode)
+        self.mode = mode
+        self.m = Filter._matcher([value], mode)
         
-    def select(self, i):
-        return self.m(getattr(i, self.attr, None))
+    def value_of(self, i):
+        return getattr(i, self.attr, None)
+
+    @property
+    def field(self):
+        return self.attr
+
+    @property
+    def values(self):
+        return [self.value]
+
+    @property
+    def cost(self):
+        # an id matches one instance, or a handful by prefix
+        if self.attr == 'id':
+            return 0
+        return MATCH_COSTS[self.mode]
+
+    def server_filter(self):
+        if self.attr not in SERVER_FILTERS or self.mode not in ('exact', 'in'):
+            return None
+        values = Filter._server_values([self.value])
+        return values and {SERVER_FILTERS[self.attr]: values}
         
     def __str__(self):
         return self.value
@@ -1182,16 +3772,29 @@ class AttributeFilter(IterableFilter):
         return self.attr
     
 class StateFilter(IterableFilter):
+    field = 'state'
+    # most instances are running, so a state rarely narrows much
+    cost = 3
+
     def __init__(self, states):
         self.states = states
+        self.m = Filter._matcher(states, 'exact')
         
-    def select(self, i):
-        return i.state in self.states
+    def value_of(self, i):
+        return i.state
+
+    @property
+    def values(self):
+        return self.states
+
+    def server_filter(self):
+        return {'instance-state-name': list(self.states)}
         
     def __str__(self):
         return ','.join(self.states)
         
 StateFilter.stopped = StateFilter(['stopped'])
+StateFilter.running = StateFilter(['running'])
 StateFilter.not_stopped = StateFilter(['running', 'pending'])
 StateFilter.not_terminated = StateFilter(['running', 'pending', 'stopped', 'stopping'])
 
@@ -1199,33 +3802,112 @@ class TagFilter(IterableFilter):
     def __init__(self, name, value, mode='exact'):
         self.name = name
         self.value = value
-        self.m = Filter._matcher(value, mode)
+        self.mode = mode
+        self.m = Filter._matcher([value], mode)
         
-    def select(self, i):
-        return self.m(i.tags.get(self.name))
+    def value_of(self, i):
+        return i.tags.get(self.name)
+
+    @property
+    def field(self):
+        return ('tag', self.name)
+
+    @property
+    def values(self):
+        return [self.value]
+
+    def server_filter(self):
+        if self.mode != 'exact':
+            return None
+        values = Filter._server_values([self.value])
+        return values and {'tag:%s' % self.name: values}
         
     def __str__(self):
         return '%s:%s' % (self.name, self.value)
     
-class LatestFilter(Filter):
+# short names for sort:<attr>, as ls titles its columns
+ORDER_ALIASES = {
+    'type': 'instance_type',
+    'zone': 'placement',
+    'ami': 'image_id',
+    'launch': 'launch_time',
+    'name': 'Name',
+}
+
+class OrderFilter(Filter):
+    """Orders instances by an attribute, keeping only the first count if given.
+
+    attr is an instance attribute such as launch_time, or failing that a tag
+    name. Picking count instances is a heap selection, O(n log count), that
+    holds no more than count instances at a time.
+    """
+    def __init__(self, attr, count=None, reverse=False, name=None):
+        self.attr = ORDER_ALIASES.get(attr, attr)
+        self.count = count
+        self.reverse = reverse
+        self.name = name
+        if self.attr in InstanceRecord.__slots__:
+            self.key = lambda i: getattr(i, self.attr)
+        else:
+            self.key = lambda i: i.tags.get(self.attr)
+
     def filter(self, li):
-        li = sorted(li, key=lambda i:i.launch_time, reverse=True)
-        # return just first
-        yield iter(li).next()
+        if self.count is None:
+            return iter(sorted(li, key=self.key, reverse=self.reverse))
+        elif self.reverse:
+            return iter(heapq.nlargest(self.count, li, key=self.key))
+        else:
+            return iter(heapq.nsmallest(self.count, li, key=self.key))
 
     def __str__(self):
-        return 'latest'
+        if self.name:
+            return self.name
+        return 'sort:%s%s' % (self.reverse and '-' or '', self.attr)
+
+    @property
+    def type(self):
+        # a new pick replaces the last, likewise a new sort
+        return self.count is None and 'sort' or 'pick'
     
 class UnionFilter(Filter):
     def __init__(self, filters):
         self.filters = filters
+        self._predicate = None
         
     def filter(self, li):
-        for i in li:
+        return itertools.ifilter(self.predicate(), li)
+
+    def predicate(self):
+        # members testing the same field the same way merge into one test: a
+        # set lookup for exact values, one startswith for prefixes, one regex
+        # alternation - so i-1 ... i-500 costs a hash lookup, not 500 compares
+        if self._predicate is None:
+            fields = collections.OrderedDict()
             for f in self.filters:
-                if f.select(i):
-                    yield i
-                    break
+                fields.setdefault((f.field, f.mode), []).append(f)
+            tests = [ (li[0].value_of, Filter._matcher([ v for f in li for v in f.values ], mode))
+                      for (field, mode), li in fields.iteritems() ]
+            if len(tests) == 1:
+                value_of, m = tests[0]
+                self._predicate = lambda i: m(value_of(i))
+            else:
+                self._predicate = lambda i: any( m(value_of(i)) for value_of, m in tests )
+        return self._predicate
+
+    @property
+    def cost(self):
+        return max( f.cost for f in self.filters )
+
+    def server_filter(self):
+        # EC2 ORs the values of one filter, but ANDs different filters
+        server = {}
+        for f in self.filters:
+            sf = f.server_filter()
+            if sf is None or (server and set(sf) != set(server)):
+                return None
+            for k, v in sf.iteritems():
+                server.setdefault(k, []).extend(v)
+        return server
 
     def __str__(self):
         return ','.join(str(f) for f in self.filters)
@@ -1249,6 +3931,8 @@ def magic_limit(ip, parameter_s):
       %limit ami-ab1234
       %limit m1.large m1.xlarge
       %limit x86_64
+      %limit latest:3        (newest 3, 'latest' for just one; or oldest:N)
+      %limit sort:-launch_time   (or sort:type, sort:zone, sort:Name...)
     """
     global iboto
     
@@ -1263,14 +3947,77 @@ re_inst_id = re.compile(r'i-\w+')
 re_tag = re.compile(r'(\w+):(.+)')
 re_ami = re.compile(r'ami-\w+')
 re_re = re.compile(r'/(.+)/')
+re_wildcard = re.compile(r'[*?\\]')
+re_pick = re.compile(r'^(latest|oldest)(?::(\d+))?$')
+re_sort = re.compile(r'^sort:(-?)(\w+)$')
 
 def magic_pop(ip, parameter_s):
     global iboto
     iboto.pop_filter()
 
+def magic_refresh(ip, parameter_s):
+    """Discard cached instance listings so the next command re-queries AWS.
+
+    Usage:\\
+      %refresh
+
+    Listings are otherwise reused for IBoto.cache_ttl seconds, and dropped
+    automatically for any account/region iboto changes instances in.
+    """
+    global iboto
+    iboto.refresh()
+
+def magic_ec2stats(ip, parameter_s):
+    """Show the EC2 requests made so far, per account, region and action.
+
+    Usage:\\
+      %ec2stats [-r] [-t]
+
+    Shows the number of calls, errors, kB received and the total, mean, 90th
+    percentile and slowest latency of each, then how many were retried
+    after EC2 throttled them (or failed with a 5xx) and the seconds lost
+    to throttling: backing off, or held back by the request rate
+    (c.IBoto.request_rate) it slows to. Options:
+      -r   reset the statistics after showing them
+      -t   toggle printing a line after each command summing up the requests
+           it made (or set c.IBoto.trace = True)
+    """
+    global iboto
+    args = parameter_s.split()
+    if '-t' in args:
+        iboto.trace = not iboto.trace
+        print 'Request trace %s' % (iboto.trace and 'on' or 'off')
+        return
+    print request_stats.report()
+    if '-r' in args:
+        request_stats.reset()
+
+def magic_offline(ip, parameter_s):
+    """Toggle answering from listings kept between sessions, without EC2.
+
+    Usage:\\
+      %offline
+
+    The last listing of each account/region is kept in ~/.iboto/fleet.db
+    (unless c.IBoto.store = False), and a new session answers from it at
+    once while listing afresh in the background; the prompt shows how old it
+    is until then. Offline, those listings are used however old and nothing
+    is listed from EC2 (or set c.IBoto.offline = True). Instances no longer
+    listed stay in the database's instances table for 30 days.
+    """
+    global iboto
+    iboto.offline = not iboto.offline
+    print 'Offline %s' % (iboto.offline and 'on' or 'off')
+
 def parse_filter(arg):
-    if arg == 'latest':
-        return LatestFilter()
+    m = re_pick.match(arg)
+    if m:
+        which, count = m.group(1), int(m.group(2) or 1)
+        return OrderFilter('launch_time', count, reverse=(which == 'latest'), name=arg)
+
+    m = re_sort.match(arg)
+    if m:
+        return OrderFilter(m.group(2), reverse=bool(m.group(1)))
     
     for k, v in ATTRIBUTE_FILTERS.iteritems():
         if arg in v:
@@ -1286,7 +4033,11 @@ def parse_filter(arg):
 
     m = re_ami.match(arg)
     if m:
-        return AttributeFilter('image_id', arg, 'startswith')
+        if len(arg) in (12, 21):
+            return AttributeFilter('image_id', arg)
+        else:
+            # partial ami
+            return AttributeFilter('image_id', arg, 'startswith')
     
     m = re_tag.match(arg)
     if m:
@@ -1302,18 +4053,36 @@ def parse_filter(arg):
         
     raise UsageError("Filter '%s' not understood" % arg)
 
+FILTER_CACHE_SIZE = 256 # parsed filter lists remembered
+
+_filter_lists = {}
+
 def parse_filter_list(parameter_s):
-    parameters = set(x for x in parameter_s.split() if x)
-    to_add = []
-    for arg in parameters:
-        f = parse_filter(arg)
-        to_add.append(f)
+    """Parse a filter list, as given to %limit, reusing the result of an earlier parse."""
+    key = ' '.join(parameter_s.split())
+    if key not in _filter_lists:
+        if len(_filter_lists) >= FILTER_CACHE_SIZE:
+            _filter_lists.clear()
+        _filter_lists[key] = _parse_filter_list(key)
+    return list(_filter_lists[key])
+
+def _parse_filter_list(parameter_s):
+    # filters of a type are ORed, in the order their types first appear
+    groups = collections.OrderedDict()
+    seen = set()
+    for arg in parameter_s.split():
+        if arg not in seen:
+            seen.add(arg)
+            f = parse_filter(arg)
+            groups.setdefault(f.type, []).append(f)
         
     l = []
-    for g, li in itertools.groupby(to_add, lambda x: x.type):
-        li = list(li)
+    for li in groups.itervalues():
         if len(li) == 1:
             l.append(li[0])
-        else:
+        elif isinstance(li[0], IterableFilter):
             l.append(UnionFilter(li))
+        else:
+            # orderings apply one after the other
+            l.extend(li)
     return l
@@ -0,0 +1,518 @@
+"""In-process stand-in for the EC2 API.
+
+MockEC2Connection is a real boto EC2Connection whose make_request answers
+from an in-memory MockFleet instead of the network, so every boto call iboto
+makes (and boto's own response parsing) runs unchanged against it.
+
+Point iboto at it with, in ~/.iboto/profile_default/ipython_config.py:
+
+    c.IBoto.backend = 'mock:size=1000,latency=0.05,rate=20'
+
+Each account then gets its own fleet of size instances spread over its
+regions; latency (seconds) is added to every request and rate caps the
+requests per second per region. Or from Python:
+
+    fleet = MockFleet(size=1000)
+    conn = MockEC2Connection(fleet, 'us-east-1', latency=0.05)
+"""
+
+import datetime
+import fnmatch
+import itertools
+import random
+import threading
+import time
+from xml.sax.saxutils import escape
+
+from boto.ec2.connection import EC2Connection
+from boto.exception import BotoServerError
+from boto.ec2.regioninfo import RegionInfo
+
+REGIONS = [ 'us-east-1', 'us-west-1', 'us-west-2', 'eu-west-1', 'ap-southeast-1', 'sa-east-1', 'ap-northeast-1' ]
+TYPES = ['m1.small', 'm1.medium', 'm1.large', 'm1.xlarge', 'c1.medium', 'c1.xlarge', 't1.micro']
+ROLES = ['web', 'db', 'cache', 'worker', 'batch', 'proxy']
+STATE_CODES = {'pending': 0, 'running': 16, 'shutting-down': 32, 'terminated': 48,
+               'stopping': 64, 'stopped': 80}
+
+# how long (seconds) a transitional state lasts before settling
+TRANSITION = 2.0
+
+XMLNS = 'http://ec2.amazonaws.com/doc/2014-10-01/'
+
+class MockError(Exception):
+    def __init__(self, status, code, message):
+        self.status = status
+        self.code = code
+        self.message = message
+
+class MockResponse(object):
+    def __init__(self, status, reason, body):
+        self.status = status
+        self.reason = reason
+        self.body = body
+
+    def read(self):
+        return self.body
+
+    def getheader(self, name, default=None):
+        return default
+
+class Transitional(object):
+    """A state that settles into another after a while."""
+    def __init__(self, state):
+        self._state = state
+        self._next = None
+        self._at = 0
+
+    def get(self):
+        if self._next and time.time() >= self._at:
+            self._state, self._next = self._next, None
+        return self._state
+
+    def set(self, state, settles_to=None, after=None):
+        self._state = state
+        self._next = settles_to
+        self._at = time.time() + (TRANSITION if after is None else after)
+
+class MockInstance(object):
+    def __init__(self, id, region, zone, instance_type, image_id, arch, launch_time, tags, state='running'):
+        self.id = id
+        self.region = region
+        self.zone = zone
+        self.instance_type = instance_type
+        self.image_id = image_id
+        self.arch = arch
+        self.launch_time = launch_time
+        self.tags = tags
+        self.groups = ['default']
+        self.volumes = {}
+        self._state = Transitional(state)
+        n = int(id[2:], 16)
+        self.ip = '10.%d.%d.%d' % ((n >> 16) & 255, (n >> 8) & 255, n & 255)
+
+    @property
+    def state(self):
+        return self._state.get()
+
+    def dns_name(self):
+        if self.state != 'running':
+            return ''
+        return 'ec2-%s.compute-1.amazonaws.com' % self.ip.replace('.', '-')
+
+class MockVolume(object):
+    def __init__(self, id, size, zone):
+        self.id = id
+        self.size = size
+        self.zone = zone
+        self._status = Transitional('creating')
+        self._status.set('creating', 'available')
+        self.instance_id = None
+        self.device = None
+
+    @property
+    def status(self):
+        return self._status.get()
+
+class MockFleet(object):
+    """A set of instances spread over regions, shared by mock connections."""
+    def __init__(self, size=100, regions=REGIONS, seed=0, first_id=0x10000000):
+        self.lock = threading.RLock()
+        self.instances = {}
+        self.volumes = {}
+        self.calls = 0
+        self._ids = itertools.count(first_id)
+        self._rand = random.Random(seed)
+        self._buckets = {}
+        start = datetime.datetime(2012, 1, 1)
+        for n in xrange(size):
+            region = regions[n % len(regions)]
+            role = self._rand.choice(ROLES)
+            launched = start + datetime.timedelta(minutes=self._rand.randint(0, 500000))
+            self.add(region,
+                     instance_type=self._rand.choice(TYPES),
+                     launch_time=launched,
+                     tags={'Name': '%s%d' % (role, n), 'Role': role},
+                     state=self._rand.choice(['running'] * 8 + ['stopped']))
+
+    def new_id(self, prefix):
+        return '%s-%08x' % (prefix, self._ids.next())
+
+    def add(self, region, instance_type='m1.small', image_id='ami-12345678', arch='x86_64',
+            launch_time=None, tags=None, state='running'):
+        zone = '%s%s' % (region, self._rand.choice('abc'))
+        inst = MockInstance(self.new_id('i'), region, zone, instance_type, image_id, arch,
+                            launch_time or datetime.datetime.utcnow(), tags or {}, state)
+        with self.lock:
+            self.instances[inst.id] = inst
+        return inst
+
+    def in_region(self, region):
+        with self.lock:
+            li = [ i for i in self.instances.itervalues() if i.region == region ]
+        li.sort(key=lambda i: i.id)
+        return li
+
+    def allow(self, region, rate):
+        """Token bucket per region, mirroring EC2's request rate limiting."""
+        if not rate:
+            return True
+        with self.lock:
+            now = time.time()
+            tokens, last = self._buckets.get(region, (rate, now))
+            tokens = min(rate, tokens + (now - last) * rate)
+            if tokens < 1:
+                self._buckets[region] = (tokens, now)
+                return False
+            self._buckets[region] = (tokens - 1, now)
+            return True
+
+######################################################
+# request parameter helpers
+######################################################
+
+def _list_param(params, label):
+    li = []
+    n = 1
+    while '%s.%d' % (label, n) in params:
+        li.append(params['%s.%d' % (label, n)])
+        n += 1
+    return li
+
+def _filters(params):
+    filters = {}
+    n = 1
+    while 'Filter.%d.Name' % n in params:
+        filters[params['Filter.%d.Name' % n]] = _list_param(params, 'Filter.%d.Value' % n)
+        n += 1
+    return filters
+
+def _tags(params):
+    tags = {}
+    n = 1
+    while 'Tag.%d.Key' % n in params:
+        tags[params['Tag.%d.Key' % n]] = params.get('Tag.%d.Value' % n)
+        n += 1
+    return tags
+
+def _match(value, patterns):
+    if value is None:
+        return False
+    if isinstance(value, (list, tuple)):
+        return any(_match(v, patterns) for v in value)
+    return any(fnmatch.fnmatchcase(value, p) for p in patterns)
+
+INSTANCE_FILTERS = {
+    'instance-id': lambda i: i.id,
+    'instance-state-name': lambda i: i.state,
+    'instance-type': lambda i: i.instance_type,
+    'architecture': lambda i: i.arch,
+    'image-id': lambda i: i.image_id,
+    'availability-zone': lambda i: i.zone,
+    'group-name': lambda i: i.groups,
+    'instance.group-name': lambda i: i.groups,
+    'tag-key': lambda i: i.tags.keys(),
+}
+
+def _instance_filter(name):
+    if name.startswith('tag:'):
+        key = name[4:]
+        return lambda i: i.tags.get(key)
+    if name not in INSTANCE_FILTERS:
+        raise MockError(400, 'InvalidParameterValue', 'The filter %r is invalid' % name)
+    return INSTANCE_FILTERS[name]
+
+######################################################
+# response rendering
+######################################################
+
+def _e(v):
+    return escape(unicode(v))
+
+def _state_xml(tag, state):
+    return '<%s><code>%d</code><name>%s</name></%s>' % (tag, STATE_CODES[state], state, tag)
+
+def _instance_xml(i):
+    tags = ''.join('<item><key>%s</key><value>%s</value></item>' % (_e(k), _e(v))
+                   for k, v in sorted(i.tags.iteritems()))
+    groups = ''.join('<item><groupId>sg-%s</groupId><groupName>%s</groupName></item>' % (abs(hash(g)) % 10**8, _e(g))
+                     for g in i.groups)
+    devices = ''.join('<item><deviceName>%s</deviceName><ebs><volumeId>%s</volumeId><status>attached</status>'
+                      '<attachTime>2012-01-01T00:00:00.000Z</attachTime><deleteOnTermination>false</deleteOnTermination></ebs></item>'
+                      % (_e(d), v) for d, v in sorted(i.volumes.iteritems()))
+    running = i.state == 'running'
+    return ('<item>'
+            '<instanceId>%(id)s</instanceId><imageId>%(image_id)s</imageId>%(state)s'
+            '<privateDnsName>%(private_dns)s</privateDnsName><dnsName>%(dns)s</dnsName>'
+            '<keyName>default</keyName><amiLaunchIndex>0</amiLaunchIndex>'
+            '<instanceType>%(type)s</instanceType><launchTime>%(launch)s</launchTime>'
+            '<placement><availabilityZone>%(zone)s</availabilityZone><groupName/><tenancy>default</tenancy></placement>'
+            '<kernelId>aki-12345678</kernelId><monitoring><state>disabled</state></monitoring>'
+            '<privateIpAddress>%(private_ip)s</privateIpAddress><ipAddress>%(ip)s</ipAddress>'
+            '<groupSet>%(groups)s</groupSet><architecture>%(arch)s</architecture>'
+            '<rootDeviceType>ebs</rootDeviceType><rootDeviceName>/dev/sda1</rootDeviceName>'
+            '<blockDeviceMapping>%(devices)s</blockDeviceMapping>'
+            '<virtualizationType>paravirtual</virtualizationType>'
+            '<tagSet>%(tags)s</tagSet><hypervisor>xen</hypervisor>'
+            '</item>') % {
+        'id': i.id, 'image_id': i.image_id, 'state': _state_xml('instanceState', i.state),
+        'private_dns': running and 'ip-%s.ec2.internal' % i.ip.replace('.', '-') or '',
+        'dns': i.dns_name(), 'type': i.instance_type,
+        'launch': i.launch_time.strftime('%Y-%m-%dT%H:%M:%S.000Z'), 'zone': i.zone,
+        'private_ip': running and i.ip or '', 'ip': running and i.ip or '',
+        'groups': groups, 'arch': i.arch, 'devices': devices, 'tags': tags,
+    }
+
+def _reservation_xml(instances, tag='item'):
+    return ('<%s><reservationId>r-%08x</reservationId><ownerId>123456789012</ownerId>'
+            '<groupSet/><instancesSet>%s</instancesSet></%s>'
+            % (tag, abs(hash(instances[0].id)) % 16**8, ''.join(_instance_xml(i) for i in instances), tag))
+
+def _volume_xml(v):
+    attachment = ''
+    if v.instance_id:
+        attachment = ('<item><volumeId>%s</volumeId><instanceId>%s</instanceId><device>%s</device>'
+                      '<status>attached</status><attachTime>2012-01-01T00:00:00.000Z</attachTime></item>'
+                      % (v.id, v.instance_id, _e(v.device)))
+    return ('<volumeId>%s</volumeId><size>%d</size><snapshotId/><availabilityZone>%s</availabilityZone>'
+            '<status>%s</status><createTime>2012-01-01T00:00:00.000Z</createTime>'
+            '<attachmentSet>%s</attachmentSet>' % (v.id, v.size, v.zone, v.status, attachment))
+
+def _response(action, body):
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n<%sResponse xmlns="%s">'
+            '<requestId>00000000-0000-0000-0000-000000000000</requestId>%s</%sResponse>'
+            % (action, XMLNS, body, action))
+
+######################################################
+# connection
+######################################################
+
+class MockEC2Connection(EC2Connection):
+    """EC2Connection answering requests from a MockFleet.
+
+    latency is added to every request (seconds); rate caps the requests per
+    second accepted per region, beyond which EC2's RequestLimitExceeded error
+    is raised, as boto raises it.
+    """
+    def __init__(self, fleet, region, latency=0.0, rate=None):
+        self.fleet = fleet
+        self.latency = latency
+        self.rate = rate
+        EC2Connection.__init__(self, aws_access_key_id='mock', aws_secret_access_key='mock',
+                               region=RegionInfo(name=region, endpoint='ec2.%s.mock' % region))
+
+    def make_request(self, action, params=None, path='/', verb='GET'):
+        params = params or {}
+        if self.latency:
+            time.sleep(self.latency)
+        with self.fleet.lock:
+            self.fleet.calls += 1
+        try:
+            if not self.fleet.allow(self.region.name, self.rate):
+                raise MockError(503, 'RequestLimitExceeded', 'Request limit exceeded.')
+            handler = getattr(self, '_' + action, None)
+            if not handler:
+                raise MockError(400, 'InvalidAction', 'The action %s is not valid for this web service.' % action)
+            with self.fleet.lock:
+                body = handler(params)
+            return MockResponse(200, 'OK', _response(action, body))
+        except MockError, ex:
+            body = ('<?xml version="1.0" encoding="UTF-8"?>\n<Response><Errors><Error><Code>%s</Code>'
+                    '<Message>%s</Message></Error></Errors><RequestID>0</RequestID></Response>'
+                    % (ex.code, _e(ex.message)))
+            if ex.status >= 500:
+                # as boto's _mexe does, once it gives up retrying
+                raise BotoServerError(ex.status, ex.code, body)
+            return MockResponse(ex.status, ex.code, body)
+
+    def _instance(self, id):
+        i = self.fleet.instances.get(id)
+        if not i or i.region != self.region.name:
+            raise MockError(400, 'InvalidInstanceID.NotFound', "The instance ID '%s' does not exist" % id)
+        return i
+
+    def _volume(self, id):
+        v = self.fleet.volumes.get(id)
+        if not v:
+            raise MockError(400, 'InvalidVolume.NotFound', "The volume '%s' does not exist." % id)
+        return v
+
+    # instances
+
+    def _DescribeInstances(self, params):
+        ids = _list_param(params, 'InstanceId')
+        if ids:
+            li = [ self._instance(id) for id in ids ]
+        else:
+            li = self.fleet.in_region(self.region.name)
+        for name, values in _filters(params).iteritems():
+            fn = _instance_filter(name)
+            li = [ i for i in li if _match(fn(i), values) ]
+
+        next_token = ''
+        if 'MaxResults' in params:
+            if ids:
+                raise MockError(400, 'InvalidParameterCombination',
+                                'The parameter instancesSet cannot be used with the parameter maxResults')
+            start = int(params.get('NextToken') or 0)
+            end = start + int(params['MaxResults'])
+            if end < len(li):
+                next_token = '<nextToken>%d</nextToken>' % end
+            li = li[start:end]
+        return '<reservationSet>%s</reservationSet>%s' % (''.join(_reservation_xml([i]) for i in li), next_token)
+
+    def _DescribeInstanceStatus(self, params):
+        ids = _list_param(params, 'InstanceId')
+        li = ids and [ self._instance(id) for id in ids ] or self.fleet.in_region(self.region.name)
+        items = []
+        for i in li:
+            if i.state != 'running' and params.get('IncludeAllInstances') != 'true':
+                continue
+            ok = i.state == 'running' and time.time() - i._state._at > TRANSITION and 'ok' or 'initializing'
+            items.append('<item><instanceId>%s</instanceId><availabilityZone>%s</availabilityZone>%s'
+                         '<systemStatus><status>%s</status></systemStatus><instanceStatus><status>%s</status></instanceStatus></item>'
+                         % (i.id, i.zone, _state_xml('instanceState', i.state), ok, ok))
+        return '<instanceStatusSet>%s</instanceStatusSet>' % ''.join(items)
+
+    def _change_state(self, params, allowed, state, settles_to):
+        items = []
+        for id in _list_param(params, 'InstanceId'):
+            i = self._instance(id)
+            previous = i.state
+            if previous in allowed:
+                i._state.set(state, settles_to)
+            elif previous not in (state, settles_to):
+                raise MockError(400, 'IncorrectInstanceState',
+                                "The instance '%s' is not in a state from which it can be %s." % (id, settles_to))
+            items.append('<item><instanceId>%s</instanceId>%s%s</item>'
+                         % (id, _state_xml('currentState', i.state), _state_xml('previousState', previous)))
+        return '<instancesSet>%s</instancesSet>' % ''.join(items)
+
+    def _StartInstances(self, params):
+        return self._change_state(params, ('stopped',), 'pending', 'running')
+
+    def _StopInstances(self, params):
+        return self._change_state(params, ('pending', 'running'), 'stopping', 'stopped')
+
+    def _TerminateInstances(self, params):
+        return self._change_state(params, ('pending', 'running', 'stopping', 'stopped'), 'shutting-down', 'terminated')
+
+    def _RebootInstances(self, params):
+        for id in _list_param(params, 'InstanceId'):
+            self._instance(id)
+        return '<return>true</return>'
+
+    def _RunInstances(self, params):
+        count = int(params.get('MaxCount', 1))
+        li = []
+        for n in xrange(count):
+            i = self.fleet.add(self.region.name, instance_type=params.get('InstanceType', 'm1.small'),
+                               image_id=params['ImageId'], state='pending')
+            if params.get('Placement.AvailabilityZone'):
+                i.zone = params['Placement.AvailabilityZone']
+            i._state.set('pending', 'running')
+            li.append(i)
+        return _reservation_xml(li)[len('<item>'):-len('</item>')]
+
+    # tags
+
+    def _CreateTags(self, params):
+        tags = _tags(params)
+        for id in _list_param(params, 'ResourceId'):
+            self._instance(id).tags.update(tags)
+        return '<return>true</return>'
+
+    def _DeleteTags(self, params):
+        tags = _tags(params)
+        for id in _list_param(params, 'ResourceId'):
+            i = self._instance(id)
+            for k, v in tags.iteritems():
+                if k in i.tags and (v is None or i.tags[k] == v):
+                    del i.tags[k]
+        return '<return>true</return>'
+
+    # volumes
+
+    def _CreateVolume(self, params):
+        v = MockVolume(self.fleet.new_id('vol'), int(params['Size']), params['AvailabilityZone'])
+        self.fleet.volumes[v.id] = v
+        return _volume_xml(v)
+
+    def _DescribeVolumes(self, params):
+        ids = _list_param(params, 'VolumeId')
+        li = [ self._volume(id) for id in ids ] if ids else sorted(self.fleet.volumes.values(), key=lambda v: v.id)
+        return '<volumeSet>%s</volumeSet>' % ''.join('<item>%s</item>' % _volume_xml(v) for v in li)
+
+    def _AttachVolume(self, params):
+        v = self._volume(params['VolumeId'])
+        if v.status != 'available':
+            raise MockError(400, 'IncorrectState', "vol '%s' is not 'available'." % v.id)
+        i = self._instance(params['InstanceId'])
+        v._status.set('in-use')
+        v.instance_id = i.id
+        v.device = params['Device']
+        i.volumes[v.device] = v.id
+        return '<return>true</return>'
+
+    def _DetachVolume(self, params):
+        v = self._volume(params['VolumeId'])
+        if v.instance_id:
+            self.fleet.instances[v.instance_id].volumes.pop(v.device, None)
+        v.instance_id = v.device = None
+        v._status.set('in-use', 'available')
+        return '<return>true</return>'
+
+    def _DeleteVolume(self, params):
+        v = self._volume(params['VolumeId'])
+        if v.status != 'available':
+            raise MockError(400, 'VolumeInUse', 'Volume %s is currently attached' % v.id)
+        del self.fleet.volumes[v.id]
+        return '<return>true</return>'
+
+    # launch metadata
+
+    def _DescribeSecurityGroups(self, params):
+        return ('<securityGroupInfo><item><ownerId>123456789012</ownerId><groupId>sg-00000001</groupId>'
+                '<groupName>default</groupName><groupDescription>default group</groupDescription>'
+                '<ipPermissions/><ipPermissionsEgress/></item></securityGroupInfo>')
+
+    def _DescribeKeyPairs(self, params):
+        return ('<keySet><item><keyName>default</keyName>'
+                '<keyFingerprint>00:00:00:00:00:00:00:00:00:00:00:00:00:00:00:00:00:00:00:00</keyFingerprint></item></keySet>')
+
+    def _DescribeAvailabilityZones(self, params):
+        return '<availabilityZoneInfo>%s</availabilityZoneInfo>' % ''.join(
+            '<item><zoneName>%s%s</zoneName><zoneState>available</zoneState><regionName>%s</regionName>'
+            '<messageSet/></item>' % (self.region.name, z, self.region.name) for z in 'abc')
+
+######################################################
+# backend
+######################################################
+
+def parse_backend(spec):
+    """Parse 'mock:size=1000,latency=0.05,rate=20' into MockFleet/connection options."""
+    options = {}
+    if ':' in spec:
+        for opt in spec.split(':', 1)[1].split(','):
+            k, v = opt.split('=', 1)
+            options[k.strip()] = float(v)
+    return options
+
+_fleets = {}
+_fleets_lock = threading.Lock()
+
+def connect(spec, account, region):
+    """A mock connection for account/region, as configured by the backend spec.
+
+    Accounts each get their own fleet, with distinct instance ids, which is
+    shared by all their regions' connections.
+    """
+    options = parse_backend(spec)
+    with _fleets_lock:
+        key = (spec, account.name)
+        if key not in _fleets:
+            n = len(_fleets)
+            _fleets[key] = MockFleet(size=int(options.get('size', 100)), regions=list(account.regions),
+                                     seed=n, first_id=0x10000000 + n * 0x1000000)
+        fleet = _fleets[key]
+    return MockEC2Connection(fleet, region, latency=options.get('latency', 0.0),
+                             rate=options.get('rate') or None)
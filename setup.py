@@ -14,6 +14,7 @@ setup(name='iboto',
       url='http://loads.pickle.me.uk/iboto/',
       install_requires=['boto >= 2.1', 'ipython >= 0.11'],
       packages=['iboto'],
+      package_data={'iboto': ['ami/*.cfg']},
       scripts=['scripts/iboto'],
       classifiers=[
         "Development Status :: 3 - Alpha",
@@ -0,0 +1,373 @@
+"""Tests of iboto's concurrency, caching, store and filters, against the mock EC2 in iboto/mock.py.
+
+Run from the checkout with:
+
+  python -m unittest discover -s tests
+"""
+
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# iboto keeps its files under ~/.iboto
+HOME = tempfile.mkdtemp()
+os.environ['HOME'] = HOME
+
+from IPython.core.error import UsageError
+
+from iboto import ipythonext as ext
+from iboto import mock
+
+def tearDownModule():
+    shutil.rmtree(HOME, ignore_errors=True)
+
+def mock_iboto(size, regions=('us-east-1',)):
+    """An IBoto selecting one account of a mock fleet of size instances per region."""
+    ib = ext.IBoto(backend=u'mock:size=%d,latency=0' % size)
+    ib.store = False
+    ext.fleet_store.enabled = False
+    account = ext.Account(name='acc0', access_key=u'mock', secret_key=u'mock', regions=list(regions))
+    ib.accounts = [account]
+    ib.filters[:] = ext.Filters([ ext.ConnectionList( ext.Connection(account, r) for r in regions ) ])
+    ext.iboto = ib
+    ext.snapshots.invalidate()
+    return ib
+
+def mock_records(size):
+    """InstanceRecords for a mock fleet of size instances, with no IBoto."""
+    fleet = mock.MockFleet(size=size, regions=['us-east-1'])
+    conn = mock.MockEC2Connection(fleet, 'us-east-1')
+    return ext.parse_instances(conn.make_request('DescribeInstances').read(), conn)
+
+class Quiet(object):
+    """Sends stderr, where warnings go, to /dev/null."""
+    def __enter__(self):
+        self.stderr = sys.stderr
+        sys.stderr = open(os.devnull, 'w')
+
+    def __exit__(self, *exc):
+        sys.stderr.close()
+        sys.stderr = self.stderr
+
+class PoolTest(unittest.TestCase):
+    def test_map(self):
+        pool = ext.Pool(width=3)
+        self.assertEqual(list(pool.map(lambda x: x * 2, range(10), ordered=True)),
+                         [ (x, x * 2) for x in range(10) ])
+        self.assertEqual(sorted(pool.map(lambda x: x * 2, range(10))), [ (x, x * 2) for x in range(10) ])
+
+    def test_failed_calls_left_out(self):
+        def fn(x):
+            if x == 3:
+                raise ValueError('no')
+            return x
+        with Quiet():
+            got = list(ext.Pool(width=2).map(fn, range(5), ordered=True))
+        self.assertEqual([ x for x, _ in got ], [0, 1, 2, 4])
+
+    def test_timeout(self):
+        release = threading.Event()
+        def fn(x):
+            if x == 'slow':
+                release.wait(5)
+            return x
+        start = time.time()
+        with Quiet():
+            got = list(ext.Pool(width=4, timeout=0.2).map(fn, ['a', 'slow', 'b']))
+        release.set()
+        self.assertEqual(sorted( x for x, _ in got ), ['a', 'b'])
+        self.assertTrue(time.time() - start < 2)
+
+    def test_wait_past_timeout(self):
+        def fn(x):
+            if x == 'slow':
+                time.sleep(0.5)
+            return x
+        with Quiet():
+            got = list(ext.Pool(width=4, timeout=0.1).map(fn, ['a', 'slow', 'b'], wait=True))
+        self.assertEqual(sorted( x for x, _ in got ), ['a', 'b', 'slow'])
+
+    def test_abandoned_calls_cancelled(self):
+        cancelled = []
+        def fn(x):
+            if x == 0:
+                return x
+            try:
+                for _ in xrange(100):
+                    ext.check_cancelled()
+                    time.sleep(0.02)
+            except ext.Cancelled:
+                cancelled.append(x)
+            return x
+        results = ext.Pool(width=4).map(fn, range(4))
+        self.assertEqual(results.next(), (0, 0))
+        results.close()
+        time.sleep(0.2)
+        self.assertEqual(sorted(cancelled), [1, 2, 3])
+
+    def test_cancelled_scope(self):
+        calls = []
+        def fn(x):
+            ext.check_cancelled()
+            calls.append(x)
+            return x
+        scope = ext.Scope()
+        scope.cancel()
+        ext._local.scope = scope
+        try:
+            self.assertEqual(list(ext.Pool(width=2).map(fn, range(4))), [])
+        finally:
+            ext._local.scope = None
+        self.assertEqual(calls, [])
+
+class SnapshotCacheTest(unittest.TestCase):
+    key = ('acc0', 'us-east-1')
+
+    def setUp(self):
+        self.cache = ext.SnapshotCache(ttl=0.2)
+        self.records = mock_records(20)
+
+    def test_ttl(self):
+        self.cache.put(self.key, self.records)
+        self.assertEqual(self.cache.get(self.key), self.records)
+        time.sleep(0.3)
+        self.assertEqual(self.cache.get(self.key), None)
+        self.assertEqual(len(self.cache.get(self.key, any_age=True)), 20)
+
+    def test_filters_answered_from_full_listing(self):
+        self.cache.put(self.key, self.records)
+        running = self.cache.get(self.key, {'instance-state-name': ['running']})
+        self.assertEqual(running, [ i for i in self.records if i.state == 'running' ])
+
+    def test_put_after_invalidation_dropped(self):
+        version = self.cache.version(self.key)
+        self.cache.invalidate([self.key])
+        self.assertFalse(self.cache.put(self.key, self.records, version=version))
+        self.assertEqual(self.cache.get(self.key), None)
+        # other account/regions are unaffected
+        other = ('acc1', 'us-east-1')
+        version = self.cache.version(other)
+        self.cache.invalidate([self.key])
+        self.assertTrue(self.cache.put(other, self.records, version=version))
+
+    def test_invalidate_all(self):
+        version = self.cache.version(self.key)
+        self.cache.invalidate()
+        self.assertFalse(self.cache.put(self.key, self.records, version=version))
+
+    def test_stale(self):
+        self.cache.put(self.key, self.records, when=time.time() - 3600, stale=True)
+        self.assertEqual(self.cache.get(self.key), self.records)
+        self.assertEqual(self.cache.get(self.key, checked=True), None)
+        self.assertTrue(self.cache.stale_age(self.key) >= 3600)
+        generation = self.cache.generation
+        self.cache.put(self.key, self.records[:5])
+        self.assertEqual(self.cache.stale_age(self.key), None)
+        self.assertTrue(self.cache.generation > generation)
+        self.assertEqual(self.cache.get(self.key, checked=True), self.records[:5])
+
+    def test_revalidation_started_once(self):
+        self.assertTrue(self.cache.start_revalidation(self.key))
+        self.assertFalse(self.cache.start_revalidation(self.key))
+        time.sleep(0.3)
+        self.assertTrue(self.cache.start_revalidation(self.key))
+
+    def test_filtered_listings_evicted(self):
+        for n in xrange(10):
+            self.cache.put(self.key, [], {'tag:Role': ['r%d' % n]})
+        self.assertEqual(len(self.cache._snapshots[self.key]), 10)
+        time.sleep(0.3)
+        self.cache.put(self.key, [], {'tag:Role': ['new']})
+        self.assertEqual(len(self.cache._snapshots[self.key]), 1)
+        self.cache.put(self.key, self.records)
+        self.assertEqual(self.cache._snapshots[self.key].keys(), [()])
+
+class FleetStoreTest(unittest.TestCase):
+    key = ('acc0', 'us-east-1')
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.store = ext.FleetStore(os.path.join(self.dir, 'fleet.db'))
+        self.records = mock_records(20)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_save_load(self):
+        when = time.time()
+        self.store.save(self.key, self.records, when)
+        loaded_when, loaded = self.store.load(self.key)
+        self.assertEqual(loaded_when, when)
+        self.assertEqual([ (i.id, i.state, i.tags) for i in loaded ],
+                         [ (i.id, i.state, i.tags) for i in self.records ])
+        self.assertEqual(self.store.load(('acc1', 'us-east-1')), None)
+
+    def test_unchanged_saved_at_intervals(self):
+        when = time.time()
+        self.store.save(self.key, self.records, when)
+        self.store.save(self.key, self.records, when + 1)
+        self.assertEqual(self.store.load(self.key)[0], when)
+        self.store.save(self.key, self.records[:10], when + 2)
+        self.assertEqual(self.store.load(self.key)[0], when + 2)
+        self.store.save(self.key, self.records[:10], when + 2 + ext.STORE_INTERVAL)
+        self.assertEqual(self.store.load(self.key)[0], when + 2 + ext.STORE_INTERVAL)
+
+    def test_later_listing_kept(self):
+        when = time.time()
+        self.store.save(self.key, self.records, when)
+        # another session saving an older listing
+        other = ext.FleetStore(self.store.path)
+        other.save(self.key, self.records[:5], when - 10)
+        self.assertEqual(len(self.store.load(self.key)[1]), 20)
+
+    def test_gone_instances_kept_as_history(self):
+        when = time.time()
+        self.store.save(self.key, self.records, when)
+        self.store.save(self.key, self.records[:5], when + 1)
+        self.assertEqual(len(self.store.load(self.key)[1]), 5)
+        db = sqlite3.connect(self.store.path)
+        try:
+            self.assertEqual(db.execute('SELECT COUNT(*) FROM instances').fetchone()[0], 20)
+        finally:
+            db.close()
+
+    def test_seed(self):
+        ib = mock_iboto(20)
+        conn = ib.connections()[0]
+        # saved by an earlier session
+        ext.FleetStore(self.store.path).save(conn.key, self.records, time.time() - 3600)
+        self.store.seed(conn)
+        self.assertEqual(len(ext.snapshots.get(conn.key)), 20)
+        self.assertTrue(ext.snapshots.stale_age(conn.key) >= 3600)
+        # once per session
+        ext.snapshots.invalidate()
+        self.store.seed(conn)
+        self.assertEqual(ext.snapshots.get(conn.key), None)
+
+    def test_concurrent_sessions(self):
+        errors = []
+        def session(n):
+            try:
+                store = ext.FleetStore(self.store.path)
+                for m in xrange(5):
+                    store.save(('acc%d' % n, 'us-east-1'), self.records, time.time() + m)
+                    store.load(('acc%d' % n, 'us-east-1'))
+            except Exception, ex:
+                errors.append(ex)
+        threads = [ threading.Thread(target=session, args=(n,)) for n in xrange(4) ]
+        with Quiet():
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        self.assertEqual(errors, [])
+
+class WaitForTest(unittest.TestCase):
+    def setUp(self):
+        self.transition = mock.TRANSITION
+        mock.TRANSITION = 0.3
+        self.ib = mock_iboto(30)
+        self.running = list(self.ib.instances.limit(ext.StateFilter.running))[:3]
+
+    def tearDown(self):
+        mock.TRANSITION = self.transition
+
+    def test_reached(self):
+        with Quiet():
+            ext.apply_action(self.running, 'stop')
+            r = ext.wait_for(self.running, 'stopped', quiet=True)
+        self.assertEqual(r.failed, {})
+        self.assertEqual(sorted( i.id for i in r.evaluate() ), sorted( i.id for i in self.running ))
+        ext.snapshots.invalidate()
+        for i in self.ib.instances.limit(ext.AttributeFilter('id', self.running[0].id)):
+            self.assertEqual(i.state, 'stopped')
+
+    def test_wont_get_there(self):
+        r = ext.wait_for(self.running, 'stopped', timeout=5, quiet=True)
+        self.assertEqual(set(r.failed.values()), set(['instance is running']))
+
+    def test_timeout(self):
+        mock.TRANSITION = 10
+        with Quiet():
+            ext.apply_action(self.running[:1], 'stop')
+            start = time.time()
+            r = ext.wait_for(self.running[:1], 'stopped', timeout=1, quiet=True)
+        self.assertTrue(time.time() - start < 3)
+        self.assertEqual(r.failed.values()[0][:9], 'timed out')
+
+    def test_unknown_state(self):
+        self.assertRaises(UsageError, ext.wait_for, self.running, 'sleeping')
+
+class SplitServerFiltersTest(unittest.TestCase):
+    def split(self, s):
+        return ext.Filters._split_server_filters(ext.parse_filter_list(s))
+
+    def test_pushed_down(self):
+        server, local = self.split('running Role:web m1.small')
+        self.assertEqual(server, {'instance-state-name': ['running'], 'tag:Role': ['web'],
+                                  'instance-type': ['m1.small']})
+        self.assertEqual(local, [])
+
+    def test_union_pushed_down(self):
+        server, local = self.split('Role:web Role:db')
+        self.assertEqual(sorted(server['tag:Role']), ['db', 'web'])
+        self.assertEqual(local, [])
+
+    def test_local_only(self):
+        server, local = self.split('/web/ running')
+        self.assertEqual(server, {'instance-state-name': ['running']})
+        self.assertEqual([ str(f) for f in local ], ['Name:web'])
+
+    def test_after_pick_stays_local(self):
+        server, local = self.split('running latest:2 m1.small')
+        self.assertEqual(server, {'instance-state-name': ['running']})
+        self.assertEqual([ type(f) for f in local ], [ext.OrderFilter, ext.AttributeFilter])
+
+    def test_listing_matches_local_filtering(self):
+        ib = mock_iboto(50)
+        filters = ext.parse_filter_list('running Role:web')
+        listed = sorted( i.id for i in ib.instances.limit(*filters) )
+        ext.snapshots.invalidate()
+        every = list(ib.instances)
+        expected = sorted( i.id for i in every if i.state == 'running' and i.tags.get('Role') == 'web' )
+        self.assertEqual(listed, expected)
+
+class ParseFilterListTest(unittest.TestCase):
+    def test_types_ored(self):
+        filters = ext.parse_filter_list('Role:web running Role:db')
+        self.assertEqual([ type(f) for f in filters ], [ext.UnionFilter, ext.AttributeFilter])
+        self.assertEqual(sorted( str(f) for f in filters[0].filters ), ['Role:db', 'Role:web'])
+
+    def test_repeats_dropped(self):
+        self.assertEqual(len(ext.parse_filter_list('Role:web Role:web')), 1)
+
+    def test_reused(self):
+        first = ext.parse_filter_list('Role:web  running')
+        again = ext.parse_filter_list(' Role:web running ')
+        self.assertEqual(first, again)
+        self.assertTrue(first[0] is again[0])
+        # callers get their own list
+        first.append(None)
+        self.assertEqual(len(ext.parse_filter_list('Role:web running')), 2)
+
+    def test_ids_and_amis(self):
+        f, = ext.parse_filter_list('i-1234abcd')
+        self.assertEqual((f.attr, f.mode), ('id', 'exact'))
+        f, = ext.parse_filter_list('i-12')
+        self.assertEqual((f.attr, f.mode), ('id', 'startswith'))
+        f, = ext.parse_filter_list('ami-1234abcd')
+        self.assertEqual((f.attr, f.mode), ('image_id', 'exact'))
+
+    def test_not_understood(self):
+        self.assertRaises(UsageError, ext.parse_filter_list, '!!')
+
+if __name__ == '__main__':
+    unittest.main()